@@ -1,34 +1,61 @@
 # app.py
-from flask import Flask, request
+from flask import Flask, request, jsonify
 import os
 from dotenv import load_dotenv
 from handlers import handle_update, auto_refresh, send_duty_reminders, daily_checkup
+import async_handlers
+from tenants import for_each_tenant, all_tenants
+from rate_limit import rate_limit_state, llm_inflight
+from llm_deadline import llm_outcomes
+from conversation import sweep_states, conversation_stats
 
 load_dotenv()
 
 app = Flask(__name__)
+ASYNC_HANDLERS = os.getenv("ASYNC_HANDLERS", "1") == "1"
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
     data = request.get_json()
     print(data)
-    handle_update(data)
+    if ASYNC_HANDLERS:
+        async_handlers.handle(data)
+    else:
+        handle_update(data)
     return "OK", 200
   
 @app.route("/refresh", methods=["GET"])
 def refresh():
-    auto_refresh()
+    for_each_tenant(auto_refresh)
     return "OK", 200
 
 @app.route("/reminder", methods=["GET"])
 def reminder():
-    send_duty_reminders()
+    for_each_tenant(send_duty_reminders)
     return "OK", 200
 
 @app.route("/wellbeing", methods=["GET"])
 def wellbeing():
-    daily_checkup()
+    for_each_tenant(daily_checkup)
     return "OK", 200
 
+@app.route("/sweep", methods=["GET"])
+def sweep():
+    for_each_tenant(sweep_states)
+    return "OK", 200
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Lists every RA by name, so it stays closed unless a token is configured
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or request.args.get("token") != admin_token:
+        return "Forbidden", 403
+    return jsonify({
+        "llm": llm_inflight(),
+        "llm_outcomes": llm_outcomes(),
+        "rate_limits": {t.tenant_id: rate_limit_state(t) for t in all_tenants()},
+        "conversations": {t.tenant_id: conversation_stats(t) for t in all_tenants()},
+    }), 200
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
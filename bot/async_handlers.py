@@ -0,0 +1,260 @@
+# async_handlers.py
+# asyncio handling path for webhook updates. Commands that make several
+# independent reads (/status, /dutyramessage, /view_*, /askmyra) issue them
+# concurrently with async clients for Upstash, Telegram and OpenAI, so they
+# take roughly the slowest call instead of the sum. Everything else falls
+# back to the sync handlers on the caller's thread.
+#
+# The coroutines run on one long-lived background event loop so the async
+# clients keep their connection pools between requests; sync callers such as
+# the Flask view use handle().
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from openai import AsyncOpenAI
+import handlers
+from handlers import (
+    TELEGRAM_API_URL, MYRA_CHAT_MODEL, MYRA_BUSY_MESSAGE, parse_command, format_status,
+    format_schedule, format_my_duties, format_duty_ra_message, rate_limited_message,
+    askmyra_rejection, unknown_scope_message, myra_messages, degraded_reply, get_user_name_from_id,
+)
+from redis_client import get_async_redis, load_duty_schedule_async
+from tenants import resolve_tenant, tenant_for_chat, tenants_for_user
+from rate_limit import take_token, acquire_llm_slot, release_llm_slot
+from retrieval import get_index, parse_scopes
+from context_builder import build_context, CANDIDATE_POOL_SIZE
+from embeddings import EMBEDDING_READ_MODELS
+from conversation import state_key, parse_entry
+from llm_deadline import MYRA_DEADLINE, complete_async, record_outcome
+
+ASYNC_COMMANDS = {"/in", "/out", "/status", "/view_schedule", "/view_mine", "/dutyramessage", "/askmyra"}
+# Threads for the sync helpers the async path still calls (rate limiting, index loads)
+ASYNC_THREAD_WORKERS = int(os.getenv("ASYNC_THREAD_WORKERS", "32"))
+
+_loop = None
+_loop_lock = threading.Lock()
+_http = None
+_openai = None
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_THREAD_WORKERS))
+            threading.Thread(target=_loop.run_forever, name="async-handlers", daemon=True).start()
+    return _loop
+
+
+def run(coro):
+    """Run coro on the shared event loop from sync code and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+def handle(data):
+    """Sync entry point: async path for ASYNC_COMMANDS, sync handlers for everything else"""
+    text = data.get("message", {}).get("text", "").strip()
+    if text.startswith("/") and parse_command(text)[0] in ASYNC_COMMANDS:
+        if run(handle_update(data)):
+            return
+    handlers.handle_update(data)
+
+
+def get_http():
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=30)
+    return _http
+
+
+def get_async_openai():
+    global _openai
+    if _openai is None:
+        _openai = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _openai
+
+
+async def send_message(chat_id, text, parse_mode="Markdown"):
+    payload = {"chat_id": chat_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    await get_http().post(f"{TELEGRAM_API_URL}/sendMessage", json=payload)
+
+
+async def embed_query(query, deadline):
+    """Query vector per read model, held to the deadline (a time.monotonic() value)"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("query embedding missed the deadline")
+    client = get_async_openai().with_options(timeout=remaining, max_retries=0)
+    responses = await asyncio.gather(*[
+        client.embeddings.create(input=[query], model=model) for model in EMBEDDING_READ_MODELS
+    ])
+    return {model: resp.data[0].embedding for model, resp in zip(EMBEDDING_READ_MODELS, responses)}
+
+
+async def pending_upload(tenant, user_id):
+    """Tags of a live /trainmyra upload request, or None"""
+    raw = await get_async_redis().hget(state_key(tenant, user_id), "train")
+    return parse_entry(raw)
+
+
+async def handle_update(data):
+    """
+    Handle an ASYNC_COMMANDS update. Returns False, without side effects, if it
+    must go through the sync handlers instead (not a command handled here, or a
+    /trainmyra upload is pending).
+    """
+    if "message" not in data:
+        return True
+
+    message = data["message"]
+    chat_id = message["chat"]["id"]
+    user_id = message["from"]["id"]
+
+    # Allowlist: only users in their tenant's friend mapping can use the bot
+    tenant = resolve_tenant(chat_id, user_id)
+    if tenant is None:
+        return True
+    if tenant_for_chat(chat_id) is None and len(tenants_for_user(user_id)) > 1:
+        # The sync handlers pick which of the user's tenants a DM belongs to
+        return False
+    user_name = get_user_name_from_id(user_id, tenant)
+
+    text = message.get("text", "").strip()
+    if not text.startswith("/"):
+        return False
+    cmd, args = parse_command(text)
+    if cmd not in ASYNC_COMMANDS:
+        return False
+
+    # A pending /trainmyra upload takes priority; check it alongside the command's reads
+    waiting = asyncio.ensure_future(pending_upload(tenant, user_id))
+    return await handle_command(chat_id, cmd, args, user_id, user_name, tenant, waiting)
+
+
+async def spend_token(chat_id, cmd, user_id, user_name, tenant):
+    """Take a rate-limit token for cmd, telling the user when they're out. Returns whether allowed"""
+    allowed, retry_after = await asyncio.to_thread(take_token, tenant, cmd, user_id)
+    if not allowed:
+        await send_message(chat_id, rate_limited_message(user_name, cmd, retry_after))
+    return allowed
+
+
+async def handle_command(chat_id, cmd, args, user_id, user_name, tenant, waiting):
+    """
+    Handle cmd; returns False without side effects if a training upload is
+    pending. Like the sync handlers, every command (except an invalid
+    /askmyra) spends a rate-limit token.
+    """
+    r = get_async_redis()
+
+    if cmd in ("/in", "/out"):
+        if await waiting is not None:
+            return False
+        if not await spend_token(chat_id, cmd, user_id, user_name, tenant):
+            return True
+        status = "IN" if cmd == "/in" else "OUT"
+        await asyncio.gather(
+            r.hset(tenant.key("user_status"), user_name, status),
+            r.hset(tenant.key("user_id_map"), user_name, str(user_id)),
+        )
+        await send_message(chat_id, f"{user_name} is now IN ✅" if status == "IN" else f"{user_name} is now OUT ❌")
+
+    elif cmd == "/status":
+        pending, statuses, duty_schedule = await asyncio.gather(
+            waiting, r.hgetall(tenant.key("user_status")), load_duty_schedule_async(tenant),
+        )
+        if pending is not None:
+            return False
+        if not await spend_token(chat_id, cmd, user_id, user_name, tenant):
+            return True
+        await send_message(chat_id, format_status(statuses, duty_schedule))
+
+    elif cmd == "/dutyramessage":
+        pending, statuses, duty_schedule = await asyncio.gather(
+            waiting, r.hgetall(tenant.key("user_status")), load_duty_schedule_async(tenant),
+        )
+        if pending is not None:
+            return False
+        if not await spend_token(chat_id, cmd, user_id, user_name, tenant):
+            return True
+        await send_message(chat_id, format_duty_ra_message(user_name, statuses, duty_schedule, args))
+
+    elif cmd in ("/view_schedule", "/view_mine"):
+        pending, duty_schedule = await asyncio.gather(waiting, load_duty_schedule_async(tenant))
+        if pending is not None:
+            return False
+        if not await spend_token(chat_id, cmd, user_id, user_name, tenant):
+            return True
+        if cmd == "/view_schedule":
+            await send_message(chat_id, format_schedule(duty_schedule))
+        else:
+            await send_message(chat_id, format_my_duties(duty_schedule, user_name))
+
+    elif cmd == "/askmyra":
+        if await waiting is not None:
+            return False
+        await askmyra(chat_id, cmd, args, user_id, user_name, tenant)
+
+    return True
+
+
+async def askmyra(chat_id, cmd, args, user_id, user_name, tenant):
+    scopes, words = parse_scopes(args)
+    prompt = " ".join(words)
+    rejection = askmyra_rejection(prompt, user_name)
+    if rejection:
+        await send_message(chat_id, rejection)
+        return
+
+    # Only a valid question spends a rate-limit token
+    if not await spend_token(chat_id, cmd, user_id, user_name, tenant):
+        return
+
+    slot = await asyncio.to_thread(acquire_llm_slot)
+    if slot is None:
+        await send_message(chat_id, MYRA_BUSY_MESSAGE)
+        return
+    asked = time.monotonic()
+    deadline = asked + MYRA_DEADLINE
+    try:
+        # Embedding the question and (re)loading the tenant's index are independent
+        embedding = asyncio.ensure_future(embed_query(prompt, deadline))
+        index = await asyncio.to_thread(get_index, handlers.collection, tenant, scopes)
+        try:
+            query_embeddings = await embedding
+        except Exception as e:
+            # Raising would 500 the webhook and Telegram would redeliver the update
+            print(f"Myra query embedding failed: {e}")
+            await send_message(chat_id, degraded_reply([]), parse_mode=None)
+            await asyncio.to_thread(record_outcome, "embed_error", time.monotonic() - asked)
+            return
+        candidates = index.search(query_embeddings, CANDIDATE_POOL_SIZE, scopes)
+        if scopes and not candidates:
+            await send_message(chat_id, unknown_scope_message(scopes))
+            return
+        context_block, context_tokens = build_context(candidates)
+        started = time.monotonic()
+        # complete_async() owns the slot from here and releases it when its call ends
+        llm_slot, slot = slot, None
+        response, outcome = await complete_async(
+            get_async_openai(), MYRA_CHAT_MODEL, myra_messages(context_block, prompt), deadline, llm_slot,
+        )
+    finally:
+        if slot:
+            await asyncio.to_thread(release_llm_slot, slot)
+
+    if response is None:
+        # Raw training text: a stray _ or * would make Telegram reject Markdown
+        await send_message(chat_id, degraded_reply(candidates), parse_mode=None)
+    else:
+        usage = getattr(response, "usage", None)
+        print(f"askmyra context: {context_tokens} tokens from {len(candidates)} candidates, prompt_tokens={getattr(usage, 'prompt_tokens', None)}")
+        print(response.choices[0].message.content)
+        await send_message(chat_id, response.choices[0].message.content)
+    await asyncio.to_thread(record_outcome, outcome, time.monotonic() - started)
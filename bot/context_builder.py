@@ -0,0 +1,114 @@
+# context_builder.py
+import os
+import numpy as np
+
+MYRA_CHAT_MODEL = "gpt-5-nano"
+
+
+def _chat_encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        # tiktoken is optional; fall back to a ~4 chars/token estimate
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(MYRA_CHAT_MODEL)
+        except KeyError:
+            # Model newer than this tiktoken release; current models use o200k_base
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"tiktoken unavailable, estimating tokens: {e}")
+        return None
+
+
+_encoding = _chat_encoding()
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("MYRA_CONTEXT_TOKEN_BUDGET", "1500"))
+CANDIDATE_POOL_SIZE = int(os.getenv("MYRA_CANDIDATE_POOL", "12"))
+MMR_LAMBDA = float(os.getenv("MYRA_MMR_LAMBDA", "0.7"))
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+
+def count_tokens(text):
+    """Count tokens locally with tiktoken, or estimate when it isn't installed"""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down so it fits in max_tokens"""
+    if max_tokens <= 0:
+        return ""
+    if _encoding is not None:
+        tokens = _encoding.encode(text)
+        return text if len(tokens) <= max_tokens else _encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def mmr_order(candidates, lambda_mult=MMR_LAMBDA):
+    """
+    Return candidate indices ordered by maximal marginal relevance.
+    Candidates are (score, chunk, embedding, model); redundancy is only
+    measured between vectors from the same embedding model.
+    """
+    if not candidates:
+        return []
+
+    relevance = np.array([score for score, _, _, _ in candidates], dtype=np.float32)
+    models = np.array([model for _, _, _, model in candidates])
+    n = len(candidates)
+    # One matrix product per model block; cross-model pairs stay 0 (their
+    # vectors aren't comparable and may not even share a dimension)
+    pairwise = np.zeros((n, n), dtype=np.float32)
+    for model in set(models):
+        idx = np.flatnonzero(models == model)
+        block = _normalize(np.asarray([candidates[i][2] for i in idx], dtype=np.float32))
+        pairwise[np.ix_(idx, idx)] = block @ block.T
+
+    selected = [int(np.argmax(relevance))]
+    remaining = set(range(n)) - set(selected)
+    while remaining:
+        rest = list(remaining)
+        redundancy = pairwise[np.ix_(rest, selected)].max(axis=1)
+        scores = lambda_mult * relevance[rest] - (1 - lambda_mult) * redundancy
+        best = rest[int(np.argmax(scores))]
+        selected.append(best)
+        remaining.remove(best)
+    return selected
+
+
+def build_context(candidates, token_budget=CONTEXT_TOKEN_BUDGET, lambda_mult=MMR_LAMBDA):
+    """
+    Pick chunks from candidates (list of (score, chunk, embedding, model))
+    with MMR and pack them into token_budget. Returns (context_block, tokens_used).
+    """
+    if not candidates:
+        return "", 0
+
+    order = mmr_order(candidates, lambda_mult)
+    separator_tokens = count_tokens(CHUNK_SEPARATOR)
+
+    picked = []
+    used = 0
+    for i in order:
+        chunk = candidates[i][1]
+        cost = count_tokens(chunk) + (separator_tokens if picked else 0)
+        if used + cost <= token_budget:
+            picked.append(chunk)
+            used += cost
+        elif not picked:
+            # Best chunk alone is over budget, keep the part that fits
+            chunk = truncate_to_tokens(chunk, token_budget)
+            picked.append(chunk)
+            used += count_tokens(chunk)
+            break
+
+    return CHUNK_SEPARATOR.join(picked), used
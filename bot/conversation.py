@@ -0,0 +1,155 @@
+# conversation.py
+# Pending multi-step interactions ("waiting for the slot number", "swap
+# request awaiting Yes/No", ...), stored as one small hash per user:
+#
+#   conv:<user_id>  field <kind>  ->  "<expires_at>|<payload>"
+#
+# Each interaction expires on its own after CONVERSATION_TTLS[kind] seconds,
+# so an abandoned flow stops catching the user's replies. A message needs
+# one HGETALL for all of the user's state instead of one HGET per kind. The
+# key itself carries a TTL, so Redis memory stays bounded even if the sweeper
+# (GET /sweep) never runs. The sweeper drops expired fields early and counts
+# them for /metrics.
+import json
+import os
+import time
+from redis_client import get_redis
+
+# kind -> seconds a pending interaction stays live
+CONVERSATION_TTLS = {
+    "train": 10 * 60,          # /trainmyra waiting for a file or photo
+    "schedule": 10 * 60,       # /update_schedule waiting for the JSON
+    "cover": 10 * 60,          # /cover_duty waiting for a slot number
+    "swap": 10 * 60,           # /swap choosing slots ("target" or "target|target slot")
+    "swap_request": 24 * 3600, # swap request waiting for the target's Yes/No
+    "wellbeing": 24 * 3600,    # wellbeing question waiting for an answer
+}
+CONVERSATION_TTLS.update({kind: int(v) for kind, v in json.loads(os.getenv("CONVERSATION_TTLS") or "{}").items()})
+
+# Expired fields stay this long past the longest TTL so the sweeper can count them
+SWEEP_GRACE = 24 * 3600
+EXPIRED_KEY = "conv_expired"
+# Per-kind hashes used before this module; the sweeper deletes them
+LEGACY_KEYS = (
+    "waiting_for_training_file", "waiting_for_schedule", "user_cover_state",
+    "user_swap_state", "active_swap_requests", "wellbeing_questions",
+)
+
+
+def state_key(tenant, user_id):
+    return tenant.key(f"conv:{user_id}")
+
+
+def pack(*values):
+    """Compact payload for structured state, e.g. a swap request"""
+    return json.dumps(values, separators=(",", ":"), ensure_ascii=False)
+
+
+def unpack(payload):
+    return json.loads(payload)
+
+
+def parse_entry(raw, now=None):
+    """Payload of a stored "<expires_at>|<payload>" value, or None if it has expired"""
+    if raw is None:
+        return None
+    expires_at, payload = raw.split("|", 1)
+    return payload if int(expires_at) > (now or time.time()) else None
+
+
+def set_state(tenant, user_id, kind, payload=""):
+    """Begin (or replace) a pending interaction of kind for user_id"""
+    r = get_redis()
+    key = state_key(tenant, user_id)
+    r.hset(key, kind, f"{int(time.time()) + CONVERSATION_TTLS[kind]}|{payload}")
+    r.expire(key, max(CONVERSATION_TTLS.values()) + SWEEP_GRACE)
+
+
+def clear_state(tenant, user_id, *kinds):
+    get_redis().hdel(state_key(tenant, user_id), *kinds)
+
+
+def _split(fields, now):
+    live, expired = {}, []
+    for kind, raw in (fields or {}).items():
+        payload = parse_entry(raw, now)
+        if payload is None:
+            expired.append(kind)
+        else:
+            live[kind] = payload
+    return live, expired
+
+
+def _drop_expired(r, tenant, user_id, expired):
+    r.hdel(state_key(tenant, user_id), *expired)
+    for kind in expired:
+        r.hincrby(tenant.key(EXPIRED_KEY), kind, 1)
+
+
+def load_state(tenant, user_id):
+    """All of user_id's live interactions as {kind: payload}; expired ones are dropped"""
+    r = get_redis()
+    live, expired = _split(r.hgetall(state_key(tenant, user_id)), time.time())
+    if expired:
+        _drop_expired(r, tenant, user_id, expired)
+    return live
+
+
+def load_state_any(tenants, user_id):
+    """
+    For a DM from a user in several tenants: (tenant, state) for the tenant
+    holding the user's most recently started live interaction, else the first
+    tenant with no state. One round trip for all tenants.
+    """
+    r = get_redis()
+    pipe = r.pipeline()
+    for tenant in tenants:
+        pipe.hgetall(state_key(tenant, user_id))
+    now = time.time()
+    best = None
+    for tenant, fields in zip(tenants, pipe.exec()):
+        live, expired = _split(fields, now)
+        if expired:
+            _drop_expired(r, tenant, user_id, expired)
+        if live:
+            started = max(int(fields[kind].split("|", 1)[0]) - CONVERSATION_TTLS.get(kind, 0) for kind in live)
+            if best is None or started > best[0]:
+                best = (started, tenant, live)
+    if best is None:
+        return tenants[0], {}
+    return best[1], best[2]
+
+
+def _all_states(r, tenant):
+    user_ids = list(tenant.friends.values())
+    pipe = r.pipeline()
+    for user_id in user_ids:
+        pipe.hgetall(state_key(tenant, user_id))
+    return zip(user_ids, pipe.exec())
+
+
+def sweep_states(tenant):
+    """Drop every expired interaction in tenant (and the legacy hashes). Returns how many expired"""
+    r = get_redis()
+    now = time.time()
+    swept = 0
+    for user_id, fields in _all_states(r, tenant):
+        _, expired = _split(fields, now)
+        if expired:
+            _drop_expired(r, tenant, user_id, expired)
+            swept += len(expired)
+    r.delete(*(tenant.key(k) for k in LEGACY_KEYS))
+    print(f"Swept {swept} expired conversation states for {tenant}")
+    return swept
+
+
+def conversation_stats(tenant):
+    """Live interactions per kind, plus how many expired unanswered, for the metrics endpoint"""
+    r = get_redis()
+    now = time.time()
+    live = {}
+    for _, fields in _all_states(r, tenant):
+        for kind in _split(fields, now)[0]:
+            live[kind] = live.get(kind, 0) + 1
+    expired = {kind: int(n) for kind, n in (r.hgetall(tenant.key(EXPIRED_KEY)) or {}).items()}
+    return {"live": live, "expired": expired}
@@ -0,0 +1,62 @@
+# embeddings.py
+import os
+
+# Model used for new training documents
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Models retrieval reads from, most preferred first. During a migration list
+# both, e.g. "text-embedding-3-large,text-embedding-3-small"
+EMBEDDING_READ_MODELS = [m.strip() for m in os.getenv("EMBEDDING_READ_MODELS", EMBEDDING_MODEL).split(",") if m.strip()]
+
+# Documents trained before the model was recorded used this one
+LEGACY_EMBEDDING_MODEL = "text-embedding-3-small"
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "100"))
+
+
+def embed_texts(client, texts, model=EMBEDDING_MODEL):
+    """Embed texts in batched requests, returning vectors in input order"""
+    vectors = []
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        batch = texts[i:i + EMBEDDING_BATCH_SIZE]
+        response = client.embeddings.create(input=batch, model=model)
+        vectors += [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+    return vectors
+
+
+def doc_vectors(doc):
+    """All vectors stored on a training doc, keyed by embedding model"""
+    vectors = {}
+    if "embedding" in doc:
+        vectors[doc.get("embedding_model", LEGACY_EMBEDDING_MODEL)] = doc["embedding"]
+    if doc.get("pending_embedding_model"):
+        vectors[doc["pending_embedding_model"]] = doc["pending_embedding"]
+    return vectors
+
+
+def pick_vector(doc, models=EMBEDDING_READ_MODELS):
+    """(model, vector) for the most preferred read model the doc has, else (None, None)"""
+    vectors = doc_vectors(doc)
+    for model in models:
+        if model in vectors:
+            return model, vectors[model]
+    return None, None
+
+
+def has_model_filter(models):
+    """Mongo query matching docs that carry a vector for any of models"""
+    clauses = [
+        {"embedding_model": {"$in": models}},
+        {"pending_embedding_model": {"$in": models}},
+    ]
+    if LEGACY_EMBEDDING_MODEL in models:
+        clauses.append({"embedding_model": {"$exists": False}})
+    return {"$or": clauses}
+
+
+def missing_model_filter(model):
+    """Mongo query matching docs that still need a vector from model"""
+    return {"$nor": [
+        {"embedding_model": model},
+        {"pending_embedding_model": model},
+    ] + ([{"embedding_model": {"$exists": False}}] if model == LEGACY_EMBEDDING_MODEL else [])}
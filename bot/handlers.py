@@ -1,11 +1,20 @@
 # handlers.py
 import datetime
 import os
+import time
 import json
 import pytz
 import requests
 from redis_client import load_duty_schedule, get_redis
+from tenants import resolve_tenant, tenant_for_chat, tenants_for_user
+from rate_limit import take_token, acquire_llm_slot, release_llm_slot
 from scheduler import should_trigger_refresh
+from context_builder import build_context, truncate_to_tokens, CANDIDATE_POOL_SIZE, MYRA_CHAT_MODEL
+from embeddings import EMBEDDING_MODEL, EMBEDDING_READ_MODELS, embed_texts
+from retrieval import get_index, bump_generation, parse_scopes, parse_tags, doc_tags
+from conversation import set_state, clear_state, load_state, load_state_any, pack, unpack
+from llm_deadline import MYRA_DEADLINE, complete, record_outcome
+from image_preprocess import preprocess_image, content_hash, get_cached_ocr, set_cached_ocr
 from openai import OpenAI
 import uuid
 import filetype
@@ -13,7 +22,6 @@ from PyPDF2 import PdfReader
 import tempfile
 from pymongo import MongoClient
 
-import numpy as np
 import random
 from dotenv import load_dotenv
 load_dotenv()
@@ -27,42 +35,69 @@ collection = mongo_client["myra_training"]["embeddings"]
 
 TELEGRAM_TOKEN = os.getenv("BOT_TOKEN")
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
-GROUP_CHAT_ID = os.getenv("GROUP_CHAT_ID")
-mappings = os.getenv("FRIEND_TELEGRAM_MAPPINGS")
-FRIEND_TELEGRAM_IDS = json.loads(mappings)
 
-def cosine_similarity(vec1, vec2):
-    vec1 = np.array(vec1)
-    vec2 = np.array(vec2)
-    return float(np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2)))
+def embed_query(query, deadline=None):
+    # One query vector per model we read from (two only while migrating).
+    # With a deadline (a time.monotonic() value) each request is held to what
+    # is left of it, without the SDK's own retries
+    vectors = {}
+    for model in EMBEDDING_READ_MODELS:
+        embed_client = client
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("query embedding missed the deadline")
+            embed_client = client.with_options(timeout=remaining, max_retries=0)
+        vectors[model] = embed_texts(embed_client, [query], model)[0]
+    return vectors
 
 
-def get_top_k_chunks(query, k=3):
+def get_top_k_candidates(query_embeddings, tenant, k=3, scopes=None):
+    # Score this tenant's cached chunks, pre-filtered to scopes (tags) if given
+    return get_index(collection, tenant, scopes).search(query_embeddings, k, scopes)
+
+
+def get_top_k_chunks(query, tenant, k=3, scopes=None):
     # Embed the user query
-    embedding = client.embeddings.create(
-        input=query,
-        model="text-embedding-3-small"
-    ).data[0].embedding
+    query_embeddings = embed_query(query)
+    return [chunk for _, chunk, _, _ in get_top_k_candidates(query_embeddings, tenant, k, scopes)]
+
+
+# Chunks quoted (each cut to MYRA_FALLBACK_CHUNK_TOKENS) when the completion misses its deadline
+MYRA_FALLBACK_CHUNKS = int(os.getenv("MYRA_FALLBACK_CHUNKS", "2"))
+MYRA_FALLBACK_CHUNK_TOKENS = int(os.getenv("MYRA_FALLBACK_CHUNK_TOKENS", "200"))
+
+MYRA_SYSTEM_PROMPT = '''You are MG Myra — a 22-year-old Singaporean Chinese student at NUS majoring in Environmental Engineering, but really the Head RA at RC4 who runs everything like it’s your empire. 
+
+Rules:
+- If the user asks a **serious/proper question** (e.g., duty info, real help), give a **short, clear, no-fluff answer**:
+  - Use bullet points if multiple points.
+  - Include steps if needed.
+  - Keep it professional and concise, not sassy.
+- If the user asks a **troll/silly question**, then:
+  - Optional Roast + Sarcasm (short, witty).
+  - Real answer (still correct, but compact).
+  - Bonus: Creative insult if the question deserves it.
 
-    # Get all embeddings from MongoDB
-    all_docs = list(collection.find({}))
-    scored = []
+Keep answers short and sweet. Do not add unnecessary personality when the user genuinely needs help.
 
-    for doc in all_docs:
-        score = cosine_similarity(embedding, doc["embedding"])
-        scored.append((score, doc["chunk"]))
+--- CONTEXT START ---
+{context_block}
+--- CONTEXT END ---
+'''
 
-    # Sort by similarity (descending) and take top-k
-    scored.sort(reverse=True, key=lambda x: x[0])
-    top_chunks = [chunk for _, chunk in scored[:k]]
 
-    return top_chunks
+def myra_messages(context_block, prompt):
+    return [
+        {"role": "system", "content": MYRA_SYSTEM_PROMPT.format(context_block=context_block)},
+        {"role": "user", "content": prompt},
+    ]
 
 
-def auto_refresh():
-  duty_schedule = load_duty_schedule()
+def auto_refresh(tenant):
+  duty_schedule = load_duty_schedule(tenant)
   if should_trigger_refresh(duty_schedule):
-    user_ids = FRIEND_TELEGRAM_IDS
+    user_ids = tenant.friends
     tomorrow_str = (datetime.datetime.now(pytz.timezone("Asia/Singapore"))).strftime("%b %d")
     closing = ""
     for slot, person in duty_schedule.items():
@@ -72,7 +107,7 @@ def auto_refresh():
       print(user, uid)
       send_message(uid, f"👋 Hi {user}, please reply /in or /out to update your status. Select IN if you will be in RC4 during the upcoming duty slot. Else select OUT. Thank you :)\n(Auto-sent for duty RA)\n{closing}")
 
-def send_duty_reminders():
+def send_duty_reminders(tenant):
     r = get_redis()
     # Get tomorrow date in Singapore timezone
     now = datetime.datetime.now(pytz.timezone("Asia/Singapore"))
@@ -81,11 +116,11 @@ def send_duty_reminders():
     # Format for matching, e.g. "Jul 24"
     tomorrow_str = tomorrow.strftime("%b %d")
     
-    if r.get("reminder_sent") == tomorrow_str:
+    if r.get(tenant.key("reminder_sent")) == tomorrow_str:
         print(f"Reminder already sent for {tomorrow_str}.")
         return
     
-    duty_schedule = load_duty_schedule()
+    duty_schedule = load_duty_schedule(tenant)
     if not duty_schedule:
         print("No duty schedule found.")
         return
@@ -96,21 +131,21 @@ def send_duty_reminders():
         # slot example: "Jul 24 (Thu) PM"
         if slot.startswith(tomorrow_str):
             # Send reminder if we have chat ID for person
-            chat_id = FRIEND_TELEGRAM_IDS.get(person)
+            chat_id = tenant.friends.get(person)
             if chat_id:
                 msg = f"👋 Hi {person}, you have a duty scheduled for *{slot}* tomorrow. Please be prepared!"
                 send_message(chat_id, msg)
                 reminder_sent = True
-                r.set("reminder_sent", tomorrow_str)
+                r.set(tenant.key("reminder_sent"), tomorrow_str)
     
     if reminder_sent:
         # Optionally notify the group
-        send_message(GROUP_CHAT_ID, f"📢 Reminders sent for duties on {tomorrow_str}.")
+        send_message(tenant.group_chat_id, f"📢 Reminders sent for duties on {tomorrow_str}.")
     else:
         print(f"No duties scheduled for {tomorrow_str}.")
 
 
-def daily_checkup():
+def daily_checkup(tenant):
     wellbeing_questions = [
     "How are you feeling today?",
     "Did you get enough sleep last night?",
@@ -191,42 +226,50 @@ def daily_checkup():
     "Have you had time for your hobbies?",
     "Do you feel you’ve made progress this semester?"
     ]
-    r = get_redis()
     friend = "Jun Wei"
-    r.hset("wellbeing_questions", friend, "true")
-    send_message(FRIEND_TELEGRAM_IDS[friend], random.choice(wellbeing_questions))
+    if friend not in tenant.friends:
+        return
+    set_state(tenant, tenant.friends[friend], "wellbeing")
+    send_message(tenant.friends[friend], random.choice(wellbeing_questions))
 
 
 
 def send_message(chat_id, text, parse_mode="Markdown"):
-    requests.post(f"{TELEGRAM_API_URL}/sendMessage", json={
-        "chat_id": chat_id,
-        "text": text,
-        "parse_mode": parse_mode
-    })
-
-def get_user_name_from_id(user_id):
-    for name, tid in FRIEND_TELEGRAM_IDS.items():
-        if tid == str(user_id):
-            return name
-    return "Unknown User"
+    payload = {"chat_id": chat_id, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    requests.post(f"{TELEGRAM_API_URL}/sendMessage", json=payload)
+
+def get_user_name_from_id(user_id, tenant):
+    return tenant.user_name(user_id) or "Unknown User"
 
 def handle_update(data):
     if "message" not in data:
         return
 
-    r = get_redis()
     message = data["message"]
     chat_id = message["chat"]["id"]
     user_id = message["from"]["id"]
-    user_name = get_user_name_from_id(user_id)
 
-    # Allowlist: only users in FRIEND_TELEGRAM_MAPPINGS can use the bot
-    if user_name == "Unknown User":
+    # Allowlist: only users in their tenant's friend mapping can use the bot
+    tenant = resolve_tenant(chat_id, user_id)
+    if tenant is None:
         return
 
+    # Every pending interaction of this user, in one lookup. A DM from someone
+    # in several tenants goes to the tenant waiting on their reply, e.g. the
+    # one holding a swap request addressed to them.
+    dm_tenants = tenants_for_user(user_id) if tenant_for_chat(chat_id) is None else []
+    if len(dm_tenants) > 1:
+        tenant, state = load_state_any(dm_tenants, user_id)
+    else:
+        state = load_state(tenant, user_id)
+    user_name = get_user_name_from_id(user_id, tenant)
+
     # Case: user is uploading file/photo while bot is expecting it
-    is_waiting = r.hget("waiting_for_training_file", str(user_id)) == "true"
+    # payload is the comma-separated tags given to /trainmyra, if any
+    waiting = state.get("train")
+    is_waiting = waiting is not None
     print(is_waiting)
 
     if is_waiting:
@@ -243,9 +286,10 @@ def handle_update(data):
             file_name = f"photo_{user_id}.jpg"
 
         if file_id:
-            r.hdel("waiting_for_training_file", str(user_id))
+            clear_state(tenant, user_id, "train")
             print("training")
-            handle_training_file(chat_id, file_id, file_name, user_id, user_name)
+            tags = waiting.split(",") if waiting else []
+            handle_training_file(chat_id, file_id, file_name, user_id, user_name, tenant, tags)
             return
         else:
             send_message(chat_id, "❌ Please send a file or photo to train Myra.")
@@ -257,44 +301,131 @@ def handle_update(data):
         return
 
     if text.startswith("/"):
-        handle_command(chat_id, text, user_id, user_name)
+        handle_command(chat_id, text, user_id, user_name, tenant)
     else:
-        handle_reply(chat_id, text, user_id, user_name)
+        handle_reply(chat_id, text, user_id, user_name, tenant, state)
 
         
-def handle_command(chat_id, text, user_id, user_name):
-    r = get_redis()
+def parse_command(text):
     cmd = text.split()[0].lower()
     if ("@rc4rabot" in cmd):
       cmd = cmd.replace("@rc4rabot", "")
     args = text.split()[1:]
+    return cmd, args
+
+
+def format_status(statuses, duty_schedule):
+    listStatus = [(k, v) for k, v in statuses.items()]
+    listStatus.sort()
+    msg = "📋 *Current Status:*\n" + "\n".join([f"{k}: {v}" for k,v in listStatus]) if statuses else "No updates yet."
+
+    today_str = (datetime.datetime.now(pytz.timezone("Asia/Singapore"))).strftime("%b %d")
+    msg += f"\n\n📅 *Duty Schedule for {today_str}:*\n" + "\n".join([f"{k}: {v}" for k,v in duty_schedule.items() if k.startswith(today_str)])
+    return msg
+
+
+def format_schedule(duty_schedule):
+    if not duty_schedule:
+        return "No duties scheduled yet."
+    return "*📅 Full Duty Schedule:*\n" + "\n".join([f"{k}: {v}" for k, v in duty_schedule.items()])
+
+
+def format_my_duties(duty_schedule, user_name):
+    my_slots = [slot for slot, name in duty_schedule.items() if name == user_name]
+    return "*👤 Your Duties:*\n" + "\n".join(my_slots) if my_slots else "You have no assigned duties."
+
+
+def format_duty_ra_message(user_name, statuses, duty_schedule, args):
+    listStatus = [(k, v) for k, v in statuses.items()]
+    listStatus.sort()
+    RAsIn = ""
+    count = 1
+    if should_trigger_refresh(duty_schedule):
+        RAsIn = "\n\nRAs/RFs in the building:\n"
+        for k, v in listStatus:
+            if v == "IN":
+                RAsIn += f"{count}) {k}\n"
+                count += 1
+    duty_slot = datetime.datetime.now(pytz.timezone("Asia/Singapore")).strftime("%d %b %Y")
+    if args and args[0]:
+        duty_slot += " " + args[0]
+    else :
+        duty_slot += " PM"
+    return f"""I ({user_name}) am the duty RA for {duty_slot}.\n\nI have collected the Duty RA phone from the letterbox. I will be staying in the building until the duty time is over.{RAsIn}
+        """
+
+
+MYRA_BUSY_MESSAGE = "Myra is busy answering other people. Ask again in a bit. -MG Myra"
+
+
+def askmyra_rejection(prompt, user_name):
+    if (len(prompt) == 0):
+        return "Eh? What do you want to ask? Don't waste my time. -MG Myra"
+    elif (len(prompt) >= 250 and user_name != "Karthik"):
+        return "Oi. Yappa yappa yappa. Don't waste my time. Can TLDR or not. -MG Myra"
+    return None
+
+
+def unknown_scope_message(scopes):
+    return f"Never learnt anything about {', '.join(scopes)} leh. Train me first. -MG Myra"
+
+
+def rate_limited_message(user_name, cmd, retry_after):
+    if retry_after == float("inf"):
+        # A bucket configured with 0 refills per minute never refills
+        return f"Wah relax lah {user_name}. You've used up all your {cmd} already. -MG Myra"
+    return f"Wah relax lah {user_name}. Try {cmd} again in {int(retry_after) + 1}s. -MG Myra"
+
+
+def degraded_reply(candidates):
+    """Retrieval-only answer for when the completion missed its deadline"""
+    if not candidates:
+        return "Brain lag. Ask again in a bit. -MG Myra"
+    excerpts = [
+        truncate_to_tokens(chunk, MYRA_FALLBACK_CHUNK_TOKENS)
+        for _, chunk, _, _ in candidates[:MYRA_FALLBACK_CHUNKS]
+    ]
+    msg = "Brain lag. No time to explain, just read my notes:\n\n"
+    msg += "\n\n".join(f"{i}. {excerpt}" for i, excerpt in enumerate(excerpts, 1))
+    return msg + "\n\n-MG Myra"
+
+
+def spend_token(chat_id, cmd, user_id, user_name, tenant):
+    """Take a rate-limit token for cmd, telling the user when they're out. Returns whether allowed"""
+    allowed, retry_after = take_token(tenant, cmd, user_id)
+    if not allowed:
+        send_message(chat_id, rate_limited_message(user_name, cmd, retry_after))
+    return allowed
+
+
+def handle_command(chat_id, text, user_id, user_name, tenant):
+    r = get_redis()
+    cmd, args = parse_command(text)
+
+    # /askmyra only spends a token once its prompt passes validation
+    if cmd != "/askmyra" and not spend_token(chat_id, cmd, user_id, user_name, tenant):
+        return
 
     if cmd == "/start":
         send_message(chat_id, "👋 RC4 RA Bot is ready!")
 
     elif cmd == "/in":
-        r.hset("user_status", user_name, "IN")
-        r.hset("user_id_map", user_name, str(user_id))
+        r.hset(tenant.key("user_status"), user_name, "IN")
+        r.hset(tenant.key("user_id_map"), user_name, str(user_id))
         send_message(chat_id, f"{user_name} is now IN ✅")
 
     elif cmd == "/out":
-        r.hset("user_status", user_name, "OUT")
-        r.hset("user_id_map", user_name, str(user_id))
+        r.hset(tenant.key("user_status"), user_name, "OUT")
+        r.hset(tenant.key("user_id_map"), user_name, str(user_id))
         send_message(chat_id, f"{user_name} is now OUT ❌")
 
     elif cmd == "/status":
-        statuses = r.hgetall("user_status")
-        listStatus = [(k, v) for k, v in statuses.items()]
-        listStatus.sort()
-        msg = "📋 *Current Status:*\n" + "\n".join([f"{k}: {v}" for k,v in listStatus]) if statuses else "No updates yet."
-        
-        duty_schedule = load_duty_schedule()
-        today_str = (datetime.datetime.now(pytz.timezone("Asia/Singapore"))).strftime("%b %d")
-        msg += f"\n\n📅 *Duty Schedule for {today_str}:*\n" + "\n".join([f"{k}: {v}" for k,v in duty_schedule.items() if k.startswith(today_str)])
-        send_message(chat_id, msg)
+        statuses = r.hgetall(tenant.key("user_status"))
+        duty_schedule = load_duty_schedule(tenant)
+        send_message(chat_id, format_status(statuses, duty_schedule))
 
     elif cmd == "/refresh":
-        user_ids = FRIEND_TELEGRAM_IDS
+        user_ids = tenant.friends
         for user, uid in user_ids.items():
           print(user, uid)
           send_message(uid, f"👋 Hi {user}, please reply /in or /out to update your status. Select IN if you will be in RC4 during the upcoming duty slot. Else select OUT. Thank you :)")
@@ -370,28 +501,22 @@ def handle_command(chat_id, text, user_id, user_name):
             send_message(chat_id, msg)
 
     elif cmd == "/view_schedule":
-        duty_schedule = load_duty_schedule()
-        if not duty_schedule:
-            send_message(chat_id, "No duties scheduled yet.")
-        else:
-            msg = "*📅 Full Duty Schedule:*\n" + "\n".join([f"{k}: {v}" for k, v in duty_schedule.items()])
-            send_message(chat_id, msg)
+        duty_schedule = load_duty_schedule(tenant)
+        send_message(chat_id, format_schedule(duty_schedule))
 
     elif cmd == "/view_mine":
-        duty_schedule = load_duty_schedule()
-        my_slots = [slot for slot, name in duty_schedule.items() if name == user_name]
-        msg = "*👤 Your Duties:*\n" + "\n".join(my_slots) if my_slots else "You have no assigned duties."
-        send_message(chat_id, msg)
+        duty_schedule = load_duty_schedule(tenant)
+        send_message(chat_id, format_my_duties(duty_schedule, user_name))
 
     elif cmd == "/update_schedule":
-        if str(chat_id) != GROUP_CHAT_ID and int(chat_id) > 0:
+        if str(chat_id) != tenant.group_chat_id and int(chat_id) > 0:
             send_message(chat_id, "❌ Only allowed in group chat.")
         else:
-            r.hset("waiting_for_schedule", str(user_id), "true")
+            set_state(tenant, user_id, "schedule")
             send_message(chat_id, "📤 Please send the full duty schedule as JSON.\n\nExample:\n```json\n{\"Jul 24 (Thu) PM\": \"Alycia\"}```")
 
     elif cmd == "/cover_duty":
-        duty_schedule = load_duty_schedule()
+        duty_schedule = load_duty_schedule(tenant)
         if not duty_schedule:
             send_message(chat_id, "❌ No duty schedule available.")
             return
@@ -399,11 +524,11 @@ def handle_command(chat_id, text, user_id, user_name):
         for i, (slot, name) in enumerate(duty_schedule.items(), 1):
             msg += f"{i}. {slot} ({name})\n"
         msg += "\n📝 Reply with the number of your choice."
-        r.hset("user_cover_state", str(user_id), "waiting_for_slot_choice")
+        set_state(tenant, user_id, "cover")
         send_message(chat_id, msg)
 
     elif cmd == "/swap_duty":
-        msg = "🔁 *Who do you want to swap with?*\n" + "\n".join([f"• {name} → type `/swap {name}`" for name in FRIEND_TELEGRAM_IDS])
+        msg = "🔁 *Who do you want to swap with?*\n" + "\n".join([f"• {name} → type `/swap {name}`" for name in tenant.friends])
         send_message(chat_id, msg)
 
     elif cmd == "/swap":
@@ -411,7 +536,7 @@ def handle_command(chat_id, text, user_id, user_name):
             send_message(chat_id, "❌ Please specify a name. Use /swap_duty to view names.")
             return
         target = " ".join(args)
-        duty_schedule = load_duty_schedule()
+        duty_schedule = load_duty_schedule(tenant)
         target_duties = [slot for slot, name in duty_schedule.items() if name == target]
         if not target_duties:
             send_message(chat_id, f"❌ {target} has no assigned duties.")
@@ -420,84 +545,70 @@ def handle_command(chat_id, text, user_id, user_name):
         for i, duty in enumerate(target_duties, 1):
             msg += f"{i}. {duty}\n"
         msg += "\n📝 Reply with the number of your choice."
-        r.hset("user_swap_state", str(user_id), target)
+        set_state(tenant, user_id, "swap", target)
         send_message(chat_id, msg)
         
     elif cmd == "/askmyra":
-      prompt = " ".join(args)
-      if (len(prompt) == 0):
-        send_message(chat_id, "Eh? What do you want to ask? Don't waste my time. -MG Myra")
+      scopes, words = parse_scopes(args)
+      prompt = " ".join(words)
+      rejection = askmyra_rejection(prompt, user_name)
+      if rejection:
+        send_message(chat_id, rejection)
         return
-      elif (len(prompt) >= 250 and user_name != "Karthik"):
-        send_message(chat_id, "Oi. Yappa yappa yappa. Don't waste my time. Can TLDR or not. -MG Myra")
+      elif not spend_token(chat_id, cmd, user_id, user_name, tenant):
         return
       else:
-        context_chunks = get_top_k_chunks(prompt, k=3)
-        context_block = "\n\n---\n\n".join(context_chunks)
-        response = client.chat.completions.create(
-    model="gpt-5-nano",
-    messages=[
-        {
-            "role": "system",
-            "content": f'''You are MG Myra — a 22-year-old Singaporean Chinese student at NUS majoring in Environmental Engineering, but really the Head RA at RC4 who runs everything like it’s your empire. 
-
-Rules:
-- If the user asks a **serious/proper question** (e.g., duty info, real help), give a **short, clear, no-fluff answer**:
-  - Use bullet points if multiple points.
-  - Include steps if needed.
-  - Keep it professional and concise, not sassy.
-- If the user asks a **troll/silly question**, then:
-  - Optional Roast + Sarcasm (short, witty).
-  - Real answer (still correct, but compact).
-  - Bonus: Creative insult if the question deserves it.
-
-Keep answers short and sweet. Do not add unnecessary personality when the user genuinely needs help.
-
---- CONTEXT START ---
-{context_block}
---- CONTEXT END ---
-'''
-        },
-        {
-            "role": "user",
-            "content": prompt
-        }
-    ],
-)
-        print(response.choices[0].message.content)
-        send_message(chat_id, response.choices[0].message.content)
+        slot = acquire_llm_slot()
+        if slot is None:
+            send_message(chat_id, MYRA_BUSY_MESSAGE)
+            return
+        asked = time.monotonic()
+        deadline = asked + MYRA_DEADLINE
+        try:
+            try:
+                query_embeddings = embed_query(prompt, deadline)
+            except Exception as e:
+                # Raising would 500 the webhook and Telegram would redeliver the update
+                print(f"Myra query embedding failed: {e}")
+                send_message(chat_id, degraded_reply([]), parse_mode=None)
+                record_outcome("embed_error", time.monotonic() - asked)
+                return
+            candidates = get_top_k_candidates(query_embeddings, tenant, k=CANDIDATE_POOL_SIZE, scopes=scopes)
+            if scopes and not candidates:
+                send_message(chat_id, unknown_scope_message(scopes))
+                return
+            context_block, context_tokens = build_context(candidates)
+            started = time.monotonic()
+            # complete() owns the slot from here and releases it when its call ends
+            llm_slot, slot = slot, None
+            response, outcome = complete(client, MYRA_CHAT_MODEL, myra_messages(context_block, prompt), deadline, llm_slot)
+        finally:
+            release_llm_slot(slot)
+        if response is None:
+            # Raw training text: a stray _ or * would make Telegram reject Markdown
+            send_message(chat_id, degraded_reply(candidates), parse_mode=None)
+        else:
+            usage = getattr(response, "usage", None)
+            print(f"askmyra context: {context_tokens} tokens from {len(candidates)} candidates, prompt_tokens={getattr(usage, 'prompt_tokens', None)}")
+            print(response.choices[0].message.content)
+            send_message(chat_id, response.choices[0].message.content)
+        record_outcome(outcome, time.monotonic() - started)
         return
     
     elif cmd == "/trainmyra":
-        if not args:
-            r.hset("waiting_for_training_file", str(user_id), "true")
+        tags, words = parse_tags(args)
+        if not words:
+            set_state(tenant, user_id, "train", ",".join(tags))
             send_message(chat_id, "📥 Please send a file or photo to train Myra.")
         else:
-            handle_training_text(chat_id, " ".join(args), user_id, user_name)
+            handle_training_text(chat_id, " ".join(words), user_id, user_name, tenant, tags)
             send_message(chat_id, "✅ Trained Myra with text.")
             return
     
     elif cmd == "/dutyramessage":
-        statuses = r.hgetall("user_status")
-        listStatus = [(k, v) for k, v in statuses.items()]
-        listStatus.sort()
-        RAsIn = ""
-        count = 1
-        duty_schedule = load_duty_schedule()
-        if should_trigger_refresh(duty_schedule):
-            RAsIn = "\n\nRAs/RFs in the building:\n"
-            for k, v in listStatus:
-                if v == "IN":
-                    RAsIn += f"{count}) {k}\n"
-                    count += 1
-        duty_slot = datetime.datetime.now(pytz.timezone("Asia/Singapore")).strftime("%d %b %Y")
-        if args and args[0]:
-            duty_slot += " " + args[0]
-        else :
-            duty_slot += " PM"
-        msg = f"""I ({user_name}) am the duty RA for {duty_slot}.\n\nI have collected the Duty RA phone from the letterbox. I will be staying in the building until the duty time is over.{RAsIn}
-        """
-        send_message(chat_id, msg)
+        statuses = r.hgetall(tenant.key("user_status"))
+        duty_schedule = load_duty_schedule(tenant)
+        send_message(chat_id, format_duty_ra_message(user_name, statuses, duty_schedule, args))
     
     elif cmd.startswith("/thankyou"):
         person = cmd.split("/thankyou")[1]
@@ -507,10 +618,10 @@ Keep answers short and sweet. Do not add unnecessary personality when the user g
         send_message(chat_id, "❌ Unknown command. Type /help to see available options.")
 
 
-def handle_reply(chat_id, text, user_id, user_name):
+def handle_reply(chat_id, text, user_id, user_name, tenant, state):
     r = get_redis()
 
-    if r.hget("waiting_for_schedule", str(user_id)) == "true":
+    if "schedule" in state:
       import ast
       try:
         json_data = json.loads(text)
@@ -518,41 +629,40 @@ def handle_reply(chat_id, text, user_id, user_name):
         try:
           json_data = ast.literal_eval(text)
           print(json_data)
-          r.set("duty_schedule", json.dumps(json_data))
-          r.hdel("waiting_for_schedule", str(user_id))
+          r.set(tenant.key("duty_schedule"), json.dumps(json_data))
+          clear_state(tenant, user_id, "schedule")
           send_message(chat_id, "✅ Duty schedule updated successfully!")
         except json.JSONDecodeError:
           send_message(chat_id, "❌ Invalid JSON. Please try again.")
-          r.hdel("waiting_for_schedule", str(user_id))
+          clear_state(tenant, user_id, "schedule")
       return
 
-    if r.hget("user_cover_state", str(user_id)) == "waiting_for_slot_choice":
+    if "cover" in state:
         try:
             choice = int(text.strip())
-            duty_schedule = json.loads(r.get("duty_schedule") or '{}')
+            duty_schedule = json.loads(r.get(tenant.key("duty_schedule")) or '{}')
             duties = list(duty_schedule.items())
             if 1 <= choice <= len(duties):
                 selected_slot, original = duties[choice - 1]
                 duty_schedule[selected_slot] = user_name
-                r.set("duty_schedule", json.dumps(duty_schedule))
-                r.hdel("user_cover_state", str(user_id))
+                r.set(tenant.key("duty_schedule"), json.dumps(duty_schedule))
+                clear_state(tenant, user_id, "cover")
                 msg = f"✅ *Duty Cover Completed!*\n\n📅 {selected_slot}: {user_name} (covering for {original})"
                 send_message(chat_id, msg)
-                send_message(GROUP_CHAT_ID, msg)
+                send_message(tenant.group_chat_id, msg)
             else:
                 send_message(chat_id, "❌ Invalid choice.")
         except ValueError:
             send_message(chat_id, "❌ Please enter a valid number.")
         return
 
-    swap_state = r.hget("user_swap_state", str(user_id))
+    swap_state = state.get("swap")
     if swap_state:
-        duty_schedule = json.loads(r.get("duty_schedule") or '{}')
-        state = swap_state.decode() if isinstance(swap_state, bytes) else swap_state
+        duty_schedule = json.loads(r.get(tenant.key("duty_schedule")) or '{}')
 
-        if "|" not in state:
+        if "|" not in swap_state:
             # User is choosing target's duty slot
-            target = state
+            target = swap_state
             target_duties = [slot for slot, name in duty_schedule.items() if name == target]
             try:
                 choice = int(text.strip())
@@ -561,7 +671,7 @@ def handle_reply(chat_id, text, user_id, user_name):
                     requester_duties = [slot for slot, name in duty_schedule.items() if name == user_name]
                     if not requester_duties:
                         send_message(chat_id, "❌ You have no duties to swap.")
-                        r.hdel("user_swap_state", str(user_id))
+                        clear_state(tenant, user_id, "swap")
                         return
 
                     msg = "🔄 *Your Duties - Choose which to swap:*\n"
@@ -570,7 +680,7 @@ def handle_reply(chat_id, text, user_id, user_name):
                     msg += "\n📝 Reply with the number of your choice."
 
                     new_state = f"{target}|{target_slot}"
-                    r.hset("user_swap_state", str(user_id), new_state)
+                    set_state(tenant, user_id, "swap", new_state)
                     send_message(chat_id, msg)
                 else:
                     send_message(chat_id, "❌ Invalid choice.")
@@ -578,27 +688,21 @@ def handle_reply(chat_id, text, user_id, user_name):
                 send_message(chat_id, "❌ Please enter a valid number.")
         else:
             # User is choosing their own duty to swap
-            target, target_slot = state.split("|", 1)
+            target, target_slot = swap_state.split("|", 1)
             requester_duties = [slot for slot, name in duty_schedule.items() if name == user_name]
             try:
                 choice = int(text.strip())
                 if 1 <= choice <= len(requester_duties):
                     requester_slot = requester_duties[choice - 1]
-                    target_chat_id = FRIEND_TELEGRAM_IDS.get(target)
+                    target_chat_id = tenant.friends.get(target)
                     if not target_chat_id:
                         send_message(chat_id, "❌ Could not find target user chat ID.")
                         return
 
                     # Store swap request for target to respond to
-                    swap_data = json.dumps({
-                        "requester": user_name,
-                        "target": target,
-                        "requester_slot": requester_slot,
-                        "target_slot": target_slot,
-                        "requester_chat_id": str(chat_id),
-                        "target_chat_id": target_chat_id
-                    })
-                    r.hset("active_swap_requests", target_chat_id, swap_data)
+                    set_state(tenant, target_chat_id, "swap_request", pack(
+                        user_name, target, requester_slot, target_slot, str(chat_id)
+                    ))
 
                     msg = f"""🔄 *Duty Swap Request*
 
@@ -610,7 +714,7 @@ def handle_reply(chat_id, text, user_id, user_name):
 Reply with *Yes* or *No*"""
                     send_message(target_chat_id, msg)
                     send_message(chat_id, f"📨 Swap request sent to {target}!")
-                    r.hdel("user_swap_state", str(user_id))
+                    clear_state(tenant, user_id, "swap")
                 else:
                     send_message(chat_id, "❌ Invalid choice.")
             except ValueError:
@@ -618,28 +722,30 @@ Reply with *Yes* or *No*"""
         return
 
     # Swap response
-    active = r.hget("active_swap_requests", str(user_id))
+    active = state.get("swap_request")
     if active:
         text_l = text.lower()
         if text_l not in ["yes", "y", "no", "n"]:
             return
-        swap_data = json.loads(active.decode() if isinstance(active, bytes) else active)
+        swap_data = dict(zip(
+            ("requester", "target", "requester_slot", "target_slot", "requester_chat_id"), unpack(active)
+        ))
         if text_l in ["yes", "y"]:
-            duty_schedule = json.loads(r.get("duty_schedule") or '{}')
+            duty_schedule = json.loads(r.get(tenant.key("duty_schedule")) or '{}')
             duty_schedule[swap_data["requester_slot"]] = swap_data["target"]
             duty_schedule[swap_data["target_slot"]] = swap_data["requester"]
-            r.set("duty_schedule", json.dumps(duty_schedule))
+            r.set(tenant.key("duty_schedule"), json.dumps(duty_schedule))
             msg = f"✅ *Duty Swap Completed!*\n\n📅 {swap_data['requester_slot']}: {swap_data['target']}\n📅 {swap_data['target_slot']}: {swap_data['requester']}"
             send_message(chat_id, msg)
             send_message(swap_data["requester_chat_id"], msg)
-            send_message(GROUP_CHAT_ID, msg)
+            send_message(tenant.group_chat_id, msg)
         else:
             send_message(chat_id, "✅ You declined the swap request.")
             send_message(swap_data["requester_chat_id"], f"❌ {swap_data['target']} declined the swap request.")
-        r.hdel("active_swap_requests", str(user_id))
+        clear_state(tenant, user_id, "swap_request")
         return
 
-    wellbeing = r.hget("wellbeing_questions", str(user_name))
+    wellbeing = "wellbeing" in state
     response_tone_scale = [
     # 1 - Mocking (Singlish)
     "Wah lao eh, again ah? Every week same story sia. You okay or not one?",
@@ -674,7 +780,7 @@ Reply with *Yes* or *No*"""
     if wellbeing:
         print("wellbeing reply")
         send_message(user_id, random.choice(response_tone_scale))
-        r.hdel("wellbeing_questions", str(user_name))
+        clear_state(tenant, user_id, "wellbeing")
         return
     
     if user_name == "Jia Xin":
@@ -685,32 +791,58 @@ Reply with *Yes* or *No*"""
     
 def extract_text_from_image_with_gpt(file_data):
     import base64
-    image_base64 = base64.b64encode(file_data).decode("utf-8")
-
-    response = client.chat.completions.create(
-        model="gpt-4.1-nano",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Please extract all readable text from this image."
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"
+    sha = content_hash(file_data)
+    cached = get_cached_ocr(sha)
+    if cached is not None:
+        print(f"OCR cache hit for {sha[:12]}")
+        return cached
+
+    # The same photo re-sent through Telegram often differs in bytes but
+    # recompresses to the same upload
+    image_data, mime = preprocess_image(file_data)
+    upload_sha = content_hash(image_data)
+    if upload_sha != sha:
+        cached = get_cached_ocr(upload_sha)
+        if cached is not None:
+            print(f"OCR cache hit for preprocessed {upload_sha[:12]}")
+            set_cached_ocr(cached, sha)
+            return cached
+
+    print(f"OCR upload: {len(file_data)} -> {len(image_data)} bytes ({mime})")
+    image_base64 = base64.b64encode(image_data).decode("utf-8")
+
+    slot = acquire_llm_slot()
+    if slot is None:
+        raise RuntimeError("Myra is busy right now, please try again in a bit")
+    try:
+        response = client.chat.completions.create(
+            model="gpt-4.1-nano",
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "Please extract all readable text from this image."
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{mime};base64,{image_base64}"
+                            }
                         }
-                    }
-                ]
-            }
-        ],
-        max_tokens=1000
-    )
-    return response.choices[0].message.content.strip()
-
-def handle_training_file(chat_id, file_id, file_name, user_id, user_name):
+                    ]
+                }
+            ],
+            max_tokens=1000
+        )
+    finally:
+        release_llm_slot(slot)
+    text = response.choices[0].message.content.strip()
+    set_cached_ocr(text, sha, upload_sha)
+    return text
+
+def handle_training_file(chat_id, file_id, file_name, user_id, user_name, tenant, tags=None):
     try:
         file_info = requests.get(f"{TELEGRAM_API_URL}/getFile?file_id={file_id}").json()
         file_path = file_info["result"]["file_path"]
@@ -753,43 +885,48 @@ def handle_training_file(chat_id, file_id, file_name, user_id, user_name):
                 chunks.append(cleaned)
 
         # Embed + insert into Mongo
-        for chunk in chunks:
-            embedding = client.embeddings.create(
-                input=chunk,
-                model="text-embedding-3-small"
-            ).data[0].embedding
-
-            doc = {
+        embeddings = embed_texts(client, chunks, EMBEDDING_MODEL)
+        doc_tag_list = sorted(doc_tags({"file_name": file_name, "tags": tags or []}))
+        docs = [
+            {
                 "_id": str(uuid.uuid4()),
+                "tenant": tenant.tenant_id,
                 "user_id": str(user_id),
                 "user_name": user_name,
                 "file_name": file_name,
+                "tags": doc_tag_list,
                 "chunk": chunk,
                 "embedding": embedding,
+                "embedding_model": EMBEDDING_MODEL,
             }
-            collection.insert_one(doc)
+            for chunk, embedding in zip(chunks, embeddings)
+        ]
+        if docs:
+            collection.insert_many(docs)
+            bump_generation(tenant)
 
         send_message(chat_id, f"✅ Trained Myra with `{file_name}` ({len(chunks)} chunks).")
 
     except Exception as e:
         send_message(chat_id, f"❌ Failed to train Myra: {str(e)}")
         
-def handle_training_text(chat_id, text, user_id, user_name):
+def handle_training_text(chat_id, text, user_id, user_name, tenant, tags=None):
     try:
-        embedding = client.embeddings.create(
-            input=text,
-            model="text-embedding-3-small"
-        ).data[0].embedding
+        embedding = embed_texts(client, [text], EMBEDDING_MODEL)[0]
 
         doc = {
             "_id": str(uuid.uuid4()),
+            "tenant": tenant.tenant_id,
             "user_id": str(user_id),
             "user_name": user_name,
             "file_name": "Text",
+            "tags": tags or [],
             "chunk": text,
             "embedding": embedding,
+            "embedding_model": EMBEDDING_MODEL,
         }
         collection.insert_one(doc)
+        bump_generation(tenant)
 
     except Exception as e:
         send_message(chat_id, f"❌ Failed to train Myra: {str(e)}")
@@ -0,0 +1,71 @@
+# image_preprocess.py
+import hashlib
+import io
+import os
+import filetype
+from PIL import Image, ImageOps
+from redis_client import get_redis
+
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "1600"))
+OCR_JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", "80"))
+OCR_CACHE_TTL = int(os.getenv("OCR_CACHE_TTL", str(30 * 24 * 3600)))  # 30 days
+
+
+def detect_image_mime(file_data):
+    """Detect the real image type from the bytes, defaulting to JPEG"""
+    kind = filetype.guess(file_data)
+    if kind and kind.mime.startswith("image/"):
+        return kind.mime
+    return "image/jpeg"
+
+
+def preprocess_image(file_data):
+    """
+    Downscale and recompress an image for OCR upload.
+    Returns (data, mime). If the image can't be decoded the original bytes are
+    returned untouched with their detected mime type.
+    """
+    mime = detect_image_mime(file_data)
+    try:
+        image = Image.open(io.BytesIO(file_data))
+        image = ImageOps.exif_transpose(image)
+    except Exception as e:
+        print(f"Image preprocessing skipped: {e}")
+        return file_data, mime
+
+    if max(image.size) > OCR_MAX_SIDE:
+        image.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+    transparent = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    if transparent:
+        # Dropping alpha would turn dark text on a transparent background into a black page
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, "white")
+        image.paste(rgba, mask=rgba.getchannel("A"))
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+    processed = out.getvalue()
+
+    # Keep the original if recompressing didn't actually make it smaller
+    # (unless it's transparent; the OCR model may not put it on white either)
+    if not transparent and len(processed) >= len(file_data) and mime in ("image/jpeg", "image/png", "image/webp", "image/gif"):
+        return file_data, mime
+    return processed, "image/jpeg"
+
+
+def content_hash(file_data):
+    return hashlib.sha256(file_data).hexdigest()
+
+
+def get_cached_ocr(sha):
+    return get_redis().get(f"ocr_cache:{sha}")
+
+
+def set_cached_ocr(text, *shas):
+    # Exact content hashes only: look-alike images (same layout, different
+    # lines) must never share OCR text
+    r = get_redis()
+    for sha in set(shas):
+        r.set(f"ocr_cache:{sha}", text, ex=OCR_CACHE_TTL)
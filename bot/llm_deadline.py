@@ -0,0 +1,199 @@
+# llm_deadline.py
+# Latency policy for Myra's chat completions.
+#
+# A completion must finish by a deadline (MYRA_DEADLINE seconds after /askmyra
+# starts). Each attempt is capped at MYRA_ATTEMPT_TIMEOUT. If MYRA_HEDGE_MODEL
+# is set and the primary model hasn't answered after MYRA_HEDGE_AFTER seconds,
+# the same prompt is also sent to the hedge model and the first answer wins.
+# Failed or timed-out attempts are retried up to MYRA_MAX_RETRIES times after a
+# jittered backoff, as long as the deadline allows. Every call, including
+# hedges, retries and calls still running after we stopped waiting, holds its
+# own LLM_MAX_INFLIGHT slot. If no answer arrives in time, the caller falls
+# back to replying with the retrieved chunks.
+#
+# Every outcome is counted in Redis with a latency histogram (see /metrics)
+# so the deadlines can be tuned.
+import asyncio
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from redis_client import get_redis
+from rate_limit import LLM_MAX_INFLIGHT, LLM_SLOT_WAIT, acquire_llm_slot, release_llm_slot
+
+MYRA_DEADLINE = float(os.getenv("MYRA_DEADLINE", "20"))
+MYRA_ATTEMPT_TIMEOUT = float(os.getenv("MYRA_ATTEMPT_TIMEOUT", "15"))
+MYRA_HEDGE_MODEL = os.getenv("MYRA_HEDGE_MODEL")
+MYRA_HEDGE_AFTER = float(os.getenv("MYRA_HEDGE_AFTER", "5"))
+MYRA_MAX_RETRIES = int(os.getenv("MYRA_MAX_RETRIES", "1"))
+MYRA_RETRY_BACKOFF = float(os.getenv("MYRA_RETRY_BACKOFF", "0.5"))
+
+OUTCOMES_KEY = "llm_outcomes"
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 30)  # seconds
+
+# Every call holds a global slot, so this process never runs more than LLM_MAX_INFLIGHT
+_pool = ThreadPoolExecutor(max_workers=LLM_MAX_INFLIGHT)
+
+
+def _create(client, model, messages, timeout):
+    # The SDK's own retries are off; retries happen here, within the deadline
+    return client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+        model=model,
+        messages=messages,
+    )
+
+
+def _hedge_at(started, timeout):
+    if MYRA_HEDGE_MODEL and MYRA_HEDGE_AFTER < timeout:
+        return started + MYRA_HEDGE_AFTER
+    return None
+
+
+def _backoff(attempt, deadline):
+    # Full jitter, never sleeping past the deadline
+    return max(0.0, min(deadline - time.monotonic(), random.uniform(0, MYRA_RETRY_BACKOFF * 2 ** attempt)))
+
+
+def _slot_wait(deadline):
+    return max(0.0, min(LLM_SLOT_WAIT, deadline - time.monotonic()))
+
+
+def _outcome(path, attempt):
+    return path if attempt == 0 else f"{path}_retry"
+
+
+def _submit(client, model, messages, timeout, slot):
+    future = _pool.submit(_create, client, model, messages, timeout)
+    # The slot stays held until the call really ends, even once nobody waits for it
+    future.add_done_callback(lambda _: release_llm_slot(slot))
+    return future
+
+
+def complete(client, model, messages, deadline, slot):
+    """
+    Chat completion under the latency policy; deadline is a time.monotonic() value.
+    slot is a held acquire_llm_slot() slot that the first call takes over and
+    releases when it ends. Hedges and retries take slots of their own: a hedge
+    is skipped if none is free, a retry waits for one within the deadline.
+    Returns (response, outcome). response is None when the deadline was blown
+    (outcome "timeout") or every attempt failed ("error").
+    """
+    outcome = "timeout"
+    for attempt in range(MYRA_MAX_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(_backoff(attempt - 1, deadline))
+            slot = acquire_llm_slot(_slot_wait(deadline))
+            if slot is None:
+                print("Myra retry skipped: no free completion slot")
+                break
+        timeout = min(MYRA_ATTEMPT_TIMEOUT, deadline - time.monotonic())
+        if timeout <= 0:
+            release_llm_slot(slot)
+            return None, "timeout"
+        started = time.monotonic()
+        hedge_at = _hedge_at(started, timeout)
+        futures = {_submit(client, model, messages, timeout, slot): "primary"}
+        while futures:
+            until = started + timeout if hedge_at is None else hedge_at
+            done, _ = wait(futures, timeout=max(0.0, until - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                try:
+                    return future.result(), _outcome(path, attempt)
+                except Exception as e:
+                    print(f"Myra {path} completion failed (attempt {attempt + 1}): {e}")
+                    outcome = "error"
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                hedge_at = None
+                hedge_slot = acquire_llm_slot(0)
+                if hedge_slot is None:
+                    print("Myra hedge skipped: no free completion slot")
+                else:
+                    hedge_timeout = started + timeout - time.monotonic()
+                    futures[_submit(client, MYRA_HEDGE_MODEL, messages, hedge_timeout, hedge_slot)] = "hedge"
+            elif futures and time.monotonic() >= started + timeout:
+                # Abandoned calls finish in the pool, bounded by their own timeout
+                print(f"Myra completion timed out after {timeout:.1f}s (attempt {attempt + 1})")
+                outcome = "timeout"
+                break
+    return None, outcome
+
+
+def _start(client, model, messages, timeout, slot):
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(_create(client, model, messages, timeout))
+    task.add_done_callback(lambda _: loop.run_in_executor(None, release_llm_slot, slot))
+    return task
+
+
+async def complete_async(client, model, messages, deadline, slot):
+    """complete() for an AsyncOpenAI client; losing requests are cancelled"""
+    outcome = "timeout"
+    for attempt in range(MYRA_MAX_RETRIES + 1):
+        if attempt > 0:
+            await asyncio.sleep(_backoff(attempt - 1, deadline))
+            slot = await asyncio.to_thread(acquire_llm_slot, _slot_wait(deadline))
+            if slot is None:
+                print("Myra retry skipped: no free completion slot")
+                break
+        timeout = min(MYRA_ATTEMPT_TIMEOUT, deadline - time.monotonic())
+        if timeout <= 0:
+            await asyncio.to_thread(release_llm_slot, slot)
+            return None, "timeout"
+        started = time.monotonic()
+        hedge_at = _hedge_at(started, timeout)
+        tasks = {_start(client, model, messages, timeout, slot): "primary"}
+        try:
+            while tasks:
+                until = started + timeout if hedge_at is None else hedge_at
+                done, _ = await asyncio.wait(tasks, timeout=max(0.0, until - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    path = tasks.pop(task)
+                    try:
+                        return task.result(), _outcome(path, attempt)
+                    except Exception as e:
+                        print(f"Myra {path} completion failed (attempt {attempt + 1}): {e}")
+                        outcome = "error"
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    hedge_slot = await asyncio.to_thread(acquire_llm_slot, 0)
+                    if hedge_slot is None:
+                        print("Myra hedge skipped: no free completion slot")
+                    else:
+                        hedge_timeout = started + timeout - time.monotonic()
+                        tasks[_start(client, MYRA_HEDGE_MODEL, messages, hedge_timeout, hedge_slot)] = "hedge"
+                elif tasks and time.monotonic() >= started + timeout:
+                    print(f"Myra completion timed out after {timeout:.1f}s (attempt {attempt + 1})")
+                    outcome = "timeout"
+                    break
+        finally:
+            # Cancelled calls release their slots from their done callbacks
+            for task in tasks:
+                task.cancel()
+    return None, outcome
+
+
+def record_outcome(outcome, seconds):
+    """Count one completion outcome and its latency in the global histogram"""
+    bucket = next((f"le_{b}" for b in LATENCY_BUCKETS if seconds <= b), "le_inf")
+    r = get_redis()
+    r.hincrby(OUTCOMES_KEY, f"{outcome}|{bucket}", 1)
+    r.hincrbyfloat(OUTCOMES_KEY, f"{outcome}|seconds", round(seconds, 3))
+    print(f"Myra completion: {outcome} in {seconds:.2f}s")
+
+
+def llm_outcomes():
+    """Counts, mean latency and latency histogram per outcome, for the metrics endpoint"""
+    stats = {}
+    for field, value in (get_redis().hgetall(OUTCOMES_KEY) or {}).items():
+        outcome, name = field.split("|", 1)
+        entry = stats.setdefault(outcome, {"count": 0, "seconds": 0.0, "buckets": {}})
+        if name == "seconds":
+            entry["seconds"] = float(value)
+        else:
+            entry["buckets"][name] = int(value)
+            entry["count"] += int(value)
+    for entry in stats.values():
+        total = entry.pop("seconds")
+        entry["avg_seconds"] = round(total / entry["count"], 3) if entry["count"] else None
+    return stats
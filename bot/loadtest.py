@@ -0,0 +1,540 @@
+# loadtest.py
+# Replays synthetic Telegram traffic against the Flask app with in-process
+# fakes for Redis, Telegram, OpenAI and Mongo, then reports throughput,
+# latency percentiles and schedule consistency.
+#
+#   python loadtest.py --users 30 --sessions 400 --workers 16
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+GROUP_CHAT_ID = "-1000000000001"
+FILE_TEXT = "Duty SOP\n\nCollect the duty phone from the letterbox before 9pm.\n\nDo rounds at 11pm and 2am, and log them in the duty book."
+
+
+def _sleep_ms(ms):
+    if ms:
+        time.sleep(random.uniform(0.5, 1.5) * ms / 1000.0)
+
+
+class FakeRedis:
+    """Thread-safe in-memory stand-in for the Upstash client, with simulated latency"""
+
+    def __init__(self, latency_ms):
+        self.latency_ms = latency_ms
+        self.data = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stale_writes = {}
+        self.calls = 0
+
+    def _call(self):
+        if not getattr(self.local, "skip_latency", False):
+            _sleep_ms(self.latency_ms)
+        self.calls += 1
+
+    def _bump(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def get(self, key):
+        self._call()
+        with self.lock:
+            # Remember what this thread read so read-modify-write races show up as stale writes
+            if not hasattr(self.local, "read_versions"):
+                self.local.read_versions = {}
+            self.local.read_versions[key] = self.versions.get(key, 0)
+            return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self._call()
+        with self.lock:
+            read = getattr(self.local, "read_versions", {}).pop(key, None)
+            if read is not None and read != self.versions.get(key, 0):
+                self.stale_writes[key] = self.stale_writes.get(key, 0) + 1
+            self.data[key] = str(value)
+            self._bump(key)
+
+    def delete(self, *keys):
+        self._call()
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+                self._bump(key)
+
+    def incr(self, key):
+        self._call()
+        with self.lock:
+            self.data[key] = str(int(self.data.get(key, 0)) + 1)
+            self._bump(key)
+            return int(self.data[key])
+
+    def hget(self, key, field):
+        self._call()
+        with self.lock:
+            return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self._call()
+        with self.lock:
+            self.data.setdefault(key, {})[field] = str(value)
+            self._bump(key)
+
+    def hdel(self, key, *fields):
+        self._call()
+        with self.lock:
+            for field in fields:
+                self.data.get(key, {}).pop(field, None)
+            self._bump(key)
+
+    def hgetall(self, key):
+        self._call()
+        with self.lock:
+            return dict(self.data.get(key, {}))
+
+    def expire(self, key, seconds):
+        self._call()
+        # TTLs aren't simulated; a run is far shorter than any of them
+        return 1 if key in self.data else 0
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hincrby(self, key, field, increment):
+        self._call()
+        with self.lock:
+            fields = self.data.setdefault(key, {})
+            fields[field] = str(int(fields.get(field, 0)) + int(increment))
+            return int(fields[field])
+
+    def hincrbyfloat(self, key, field, increment):
+        self._call()
+        with self.lock:
+            fields = self.data.setdefault(key, {})
+            fields[field] = str(float(fields.get(field, 0)) + float(increment))
+            return float(fields[field])
+
+    def zrem(self, key, *members):
+        self._call()
+        with self.lock:
+            for member in members:
+                self.data.get(key, {}).pop(member, None)
+
+    def zcount(self, key, lo, hi):
+        self._call()
+        with self.lock:
+            hi = float("inf") if hi == "+inf" else float(hi)
+            return sum(1 for score in self.data.get(key, {}).values() if float(lo) <= score <= hi)
+
+    def eval(self, script, keys=None, args=None):
+        import rate_limit
+        self._call()
+        with self.lock:
+            if script == rate_limit._TAKE_TOKEN:
+                field, capacity, rate, now = args[0], float(args[1]), float(args[2]), float(args[3])
+                bucket = self.data.setdefault(keys[0], {})
+                tokens, ts = (float(x) for x in bucket.get(field, f"{capacity}|{now}").split("|"))
+                tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+                allowed = 1 if tokens >= 1 else 0
+                tokens -= allowed
+                bucket[field] = f"{tokens}|{now}"
+                return [allowed, str(tokens)]
+            if script == rate_limit._ACQUIRE_SLOT:
+                now, lease, limit, member = float(args[0]), float(args[1]), int(args[2]), args[3]
+                slots = self.data.setdefault(keys[0], {})
+                for m in [m for m, score in slots.items() if score <= now - lease]:
+                    del slots[m]
+                if len(slots) < limit:
+                    slots[member] = now
+                    return 1
+                return 0
+        raise NotImplementedError("FakeRedis.eval only knows the rate_limit scripts")
+
+
+class FakePipeline:
+    """Queues FakeRedis calls and runs them as one round trip on exec()"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def exec(self):
+        self.redis._call()
+        self.redis.local.skip_latency = True
+        try:
+            return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        finally:
+            self.redis.local.skip_latency = False
+
+
+class FakeAsyncRedis:
+    """Async facade over a FakeRedis; the simulated latency is awaited instead of slept"""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.redis.latency_ms / 1000.0)
+            self.redis.local.skip_latency = True
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.redis.local.skip_latency = False
+        return call
+
+
+class FakeTelegram:
+    """Replaces the `requests` module inside handlers"""
+
+    def __init__(self, latency_ms):
+        self.latency_ms = latency_ms
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def post(self, url, json=None, **kwargs):
+        _sleep_ms(self.latency_ms)
+        if url.endswith("/sendMessage"):
+            with self.lock:
+                self.sent.append((str(json["chat_id"]), json["text"]))
+        return SimpleNamespace(json=lambda: {"ok": True, "result": {}})
+
+    def get(self, url, **kwargs):
+        _sleep_ms(self.latency_ms)
+        if "/getFile" in url:
+            return SimpleNamespace(json=lambda: {"ok": True, "result": {"file_path": "documents/sop.txt"}})
+        return SimpleNamespace(content=FILE_TEXT.encode("utf-8"))
+
+
+class FakeAsyncTelegram:
+    """Replaces the httpx client used by async_handlers"""
+
+    def __init__(self, telegram):
+        self.telegram = telegram
+
+    async def post(self, url, json=None, **kwargs):
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.telegram.latency_ms / 1000.0)
+        with self.telegram.lock:
+            self.telegram.sent.append((str(json["chat_id"]), json["text"]))
+
+
+class FakeOpenAI:
+    def __init__(self, latency_ms, dim=64):
+        self.latency_ms = latency_ms
+        self.dim = dim
+        self.embeddings = SimpleNamespace(create=self._embed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+
+    def with_options(self, **kwargs):
+        return self
+
+    def _vector(self, text):
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+        return random.Random(seed).sample(range(-1000, 1000), self.dim)
+
+    def _embed(self, input, model):
+        _sleep_ms(self.latency_ms / 4)
+        texts = input if isinstance(input, list) else [input]
+        return SimpleNamespace(data=[SimpleNamespace(embedding=self._vector(t), index=i) for i, t in enumerate(texts)])
+
+    def _chat(self, model, messages, **kwargs):
+        _sleep_ms(self.latency_ms)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Collect the phone lah."))],
+            usage=SimpleNamespace(prompt_tokens=sum(len(m["content"]) // 4 for m in messages)),
+        )
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, openai):
+        self.openai = openai
+        self.embeddings = SimpleNamespace(create=self._embed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+
+    def with_options(self, **kwargs):
+        return self
+
+    async def _embed(self, input, model):
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.openai.latency_ms / 4000.0)
+        texts = input if isinstance(input, list) else [input]
+        return SimpleNamespace(data=[SimpleNamespace(embedding=self.openai._vector(t), index=i) for i, t in enumerate(texts)])
+
+    async def _chat(self, model, messages, **kwargs):
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.openai.latency_ms / 1000.0)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Collect the phone lah."))],
+            usage=SimpleNamespace(prompt_tokens=sum(len(m["content"]) // 4 for m in messages)),
+        )
+
+
+class FakeCollection:
+    def __init__(self, latency_ms):
+        self.latency_ms = latency_ms
+        self.lock = threading.Lock()
+        self.docs = []
+
+    def find(self, query=None, projection=None):
+        _sleep_ms(self.latency_ms)
+        with self.lock:
+            return list(self.docs)
+
+    def insert_one(self, doc):
+        _sleep_ms(self.latency_ms)
+        with self.lock:
+            self.docs.append(doc)
+
+    def insert_many(self, docs):
+        _sleep_ms(self.latency_ms)
+        with self.lock:
+            self.docs.extend(docs)
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+
+def install_fakes(friends, latency, use_async=True):
+    """Configure env and swap every external client for a fake. Returns (app, fakes)"""
+    os.environ["ASYNC_HANDLERS"] = "1" if use_async else "0"
+    os.environ["GROUP_CHAT_ID"] = GROUP_CHAT_ID
+    os.environ["FRIEND_TELEGRAM_MAPPINGS"] = json.dumps(friends)
+    os.environ.pop("TENANTS", None)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-loadtest")
+    os.environ.setdefault("BOT_TOKEN", "loadtest")
+
+    import app as app_module
+    import async_handlers
+    import handlers
+    import redis_client
+    import rate_limit
+    import retrieval
+    import image_preprocess
+    import conversation
+    import llm_deadline
+
+    redis = FakeRedis(latency["redis"])
+    telegram = FakeTelegram(latency["telegram"])
+    openai = FakeOpenAI(latency["openai"])
+    collection = FakeCollection(latency["mongo"])
+
+    for module in (handlers, redis_client, rate_limit, retrieval, image_preprocess, llm_deadline, conversation):
+        module.get_redis = lambda: redis
+    handlers.requests = telegram
+    handlers.client = openai
+    handlers.collection = collection
+
+    async_redis = FakeAsyncRedis(redis)
+    redis_client.get_async_redis = lambda: async_redis
+    async_handlers.get_async_redis = lambda: async_redis
+    async_telegram = FakeAsyncTelegram(telegram)
+    async_handlers.get_http = lambda: async_telegram
+    async_openai = FakeAsyncOpenAI(openai)
+    async_handlers.get_async_openai = lambda: async_openai
+    return app_module.app, SimpleNamespace(redis=redis, telegram=telegram, openai=openai, collection=collection)
+
+
+def make_schedule(names, days=14):
+    schedule = {}
+    start = time.time()
+    for d in range(days):
+        day = time.strftime("%b %d (%a)", time.localtime(start + d * 86400))
+        schedule[f"{day} PM"] = names[(2 * d) % len(names)]
+        schedule[f"{day} AM"] = names[(2 * d + 1) % len(names)]
+    return schedule
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.lock = threading.Lock()
+
+    def _next_id(self):
+        with self.lock:
+            self.update_id += 1
+            return self.update_id
+
+    def message(self, user_id, chat_id, **fields):
+        msg = {"message_id": self._next_id(), "chat": {"id": int(chat_id)}, "from": {"id": int(user_id)}}
+        msg.update(fields)
+        return {"update_id": msg["message_id"], "message": msg}
+
+    def text(self, user_id, text, chat_id=None):
+        return self.message(user_id, chat_id or user_id, text=text)
+
+    def document(self, user_id, file_name="duty-sop.txt"):
+        return self.message(user_id, user_id, document={"file_id": f"f{self._next_id()}", "file_name": file_name})
+
+
+def build_sessions(friends, schedule, sessions, rng):
+    """
+    A session is an ordered list of updates from one conversation; sessions run
+    concurrently, updates inside a session run in order.
+    """
+    factory = UpdateFactory()
+    names = list(friends)
+    mix = [
+        ("status", 45), ("swap", 15), ("cover", 10), ("train", 5),
+        ("ask", 10), ("view", 10), ("dutyramessage", 5),
+    ]
+    kinds = [k for k, w in mix for _ in range(w)]
+    out = []
+    for _ in range(sessions):
+        kind = rng.choice(kinds)
+        name = rng.choice(names)
+        uid = friends[name]
+        if kind == "status":
+            out.append((kind, [
+                factory.text(uid, rng.choice(["/in", "/out"]), GROUP_CHAT_ID),
+                factory.text(uid, "/status", GROUP_CHAT_ID),
+            ]))
+        elif kind == "swap":
+            target = rng.choice([n for n in names if n != name])
+            target_slots = [s for s, n in schedule.items() if n == target]
+            own_slots = [s for s, n in schedule.items() if n == name]
+            if not target_slots or not own_slots:
+                continue
+            out.append((kind, [
+                factory.text(uid, f"/swap {target}"),
+                factory.text(uid, str(rng.randint(1, len(target_slots)))),
+                factory.text(uid, str(rng.randint(1, len(own_slots)))),
+                factory.text(friends[target], rng.choice(["yes", "yes", "no"])),
+            ]))
+        elif kind == "cover":
+            out.append((kind, [
+                factory.text(uid, "/cover_duty"),
+                factory.text(uid, str(rng.randint(1, len(schedule)))),
+            ]))
+        elif kind == "train":
+            out.append((kind, [
+                factory.text(uid, "/trainmyra tag:duty-sop"),
+                factory.document(uid),
+            ]))
+        elif kind == "ask":
+            out.append((kind, [factory.text(uid, "/askmyra in:duty-sop when do I collect the duty phone", GROUP_CHAT_ID)]))
+        elif kind == "view":
+            out.append((kind, [factory.text(uid, rng.choice(["/view_schedule", "/view_mine"]))]))
+        else:
+            out.append((kind, [factory.text(uid, "/dutyramessage PM", GROUP_CHAT_ID)]))
+    return out
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def check_consistency(fakes, friends, initial_schedule):
+    """Returns (problems, notes); notes are expected leftovers, not failures"""
+    problems = []
+    notes = []
+    schedule = json.loads(fakes.redis.data.get("duty_schedule") or "{}")
+    if set(schedule) != set(initial_schedule):
+        problems.append(f"slot set changed: {len(initial_schedule)} -> {len(schedule)} slots")
+    unknown = {n for n in schedule.values() if n not in friends}
+    if unknown:
+        problems.append(f"slots assigned to unknown users: {sorted(unknown)}")
+    statuses = fakes.redis.data.get("user_status", {})
+    bad = {k: v for k, v in statuses.items() if v not in ("IN", "OUT") or k not in friends}
+    if bad:
+        problems.append(f"invalid statuses: {bad}")
+    left = {}
+    for key, fields in fakes.redis.data.items():
+        if key.startswith("conv:"):
+            for kind in fields:
+                left[kind] = left.get(kind, 0) + 1
+    for kind, count in sorted(left.items()):
+        # Abandoned or misrouted conversations, e.g. a number that went out of range after a concurrent swap
+        notes.append(f"{count} unfinished {kind} conversations left (they expire on their own)")
+    for key, count in sorted(fakes.redis.stale_writes.items()):
+        problems.append(f"{count} lost updates on {key} (written from a stale read)")
+    return problems, notes
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    friends = {f"RA {i:02d}": str(100000 + i) for i in range(args.users)}
+    latency = {"redis": args.redis_ms, "telegram": args.telegram_ms, "openai": args.openai_ms, "mongo": args.mongo_ms}
+    app, fakes = install_fakes(friends, latency, use_async=not args.sync)
+
+    schedule = make_schedule(list(friends))
+    fakes.redis.data["duty_schedule"] = json.dumps(schedule)
+    sessions = build_sessions(friends, schedule, args.sessions, rng)
+    n_updates = sum(len(updates) for _, updates in sessions)
+
+    latencies = {}
+    errors = []
+    lock = threading.Lock()
+
+    def play(session):
+        kind, updates = session
+        http = app.test_client()
+        for update in updates:
+            fakes.redis.local.read_versions = {}
+            t0 = time.perf_counter()
+            resp = http.post("/webhook", json=update)
+            elapsed = (time.perf_counter() - t0) * 1000
+            with lock:
+                latencies.setdefault(kind, []).append(elapsed)
+                if resp.status_code != 200:
+                    errors.append((kind, resp.status_code))
+
+    mode = "sync" if args.sync else "async"
+    print(f"Replaying {n_updates} updates in {len(sessions)} sessions with {args.workers} workers ({mode} handlers)...")
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            list(pool.map(play, sessions))
+        wall = time.perf_counter() - start
+
+    all_latencies = [ms for values in latencies.values() for ms in values]
+    print(f"\nThroughput: {n_updates / wall:.1f} updates/s ({n_updates} updates in {wall:.2f}s)")
+    print(f"Errors: {len(errors)}")
+    print(f"Fake I/O: {fakes.redis.calls} Redis calls, {len(fakes.telegram.sent)} Telegram messages, {len(fakes.collection.docs)} Mongo docs")
+    print(f"\n{'kind':<15}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, values in sorted(latencies.items()) + [("all", all_latencies)]:
+        print(f"{kind:<15}{len(values):>7}{percentile(values, 50):>10.1f}{percentile(values, 90):>10.1f}"
+              f"{percentile(values, 99):>10.1f}{max(values, default=0):>10.1f}")
+
+    print("\nConsistency:")
+    problems, notes = check_consistency(fakes, friends, schedule)
+    for problem in problems or ["OK"]:
+        print(f"  {problem}")
+    for note in notes:
+        print(f"  note: {note}")
+    return 1 if errors or problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the webhook with synthetic Telegram traffic")
+    parser.add_argument("--users", type=int, default=30)
+    parser.add_argument("--sessions", type=int, default=400)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=4)
+    parser.add_argument("--redis-ms", type=float, default=5, help="simulated Upstash round trip")
+    parser.add_argument("--telegram-ms", type=float, default=40, help="simulated Telegram API round trip")
+    parser.add_argument("--openai-ms", type=float, default=400, help="simulated chat completion time")
+    parser.add_argument("--mongo-ms", type=float, default=10, help="simulated Mongo round trip")
+    parser.add_argument("--sync", action="store_true", help="use the sync handlers instead of async_handlers")
+    raise SystemExit(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
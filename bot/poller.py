@@ -0,0 +1,115 @@
+# poller.py
+# Long-polling alternative to the /webhook route for self-hosted deployments.
+# Run with `python poller.py` instead of registering a webhook.
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from dotenv import load_dotenv
+from handlers import handle_update, TELEGRAM_API_URL
+
+load_dotenv()
+
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+POLL_BATCH_SIZE = int(os.getenv("POLL_BATCH_SIZE", "100"))
+POLL_WORKERS = int(os.getenv("POLL_WORKERS", "8"))
+# Stop fetching while this many dispatched updates are still waiting for a worker
+POLL_MAX_BACKLOG = int(os.getenv("POLL_MAX_BACKLOG", "1000"))
+
+
+def get_updates(offset):
+    resp = requests.get(f"{TELEGRAM_API_URL}/getUpdates", params={
+        "offset": offset,
+        "timeout": POLL_TIMEOUT,
+        "limit": POLL_BATCH_SIZE,
+        "allowed_updates": '["message"]',
+    }, timeout=POLL_TIMEOUT + 10)
+    data = resp.json()
+    if not data.get("ok"):
+        raise RuntimeError(data.get("description", "getUpdates failed"))
+    return data["result"]
+
+
+def group_by_chat(updates):
+    """Split a batch into {chat_id: updates}, keeping each chat's updates in order"""
+    groups = OrderedDict()
+    for update in updates:
+        chat_id = update.get("message", {}).get("chat", {}).get("id")
+        groups.setdefault(chat_id, []).append(update)
+    return groups
+
+
+def process_update(update):
+    try:
+        handle_update(update)
+    except Exception as e:
+        print(f"Failed to handle update {update.get('update_id')}: {e}")
+
+
+class ChatQueues:
+    """
+    Per-chat update queues drained by a worker pool. A chat's updates run in
+    order on at most one worker at a time; different chats run in parallel,
+    and a slow chat never holds up the others or the next getUpdates.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.queues = {}  # chat_id -> deque of updates, present while a worker drains it
+
+    def dispatch(self, chat_id, updates):
+        with self.lock:
+            queue = self.queues.get(chat_id)
+            if queue is not None:
+                # The chat's worker picks these up after what it already has
+                queue.extend(updates)
+                return
+            self.queues[chat_id] = deque(updates)
+        self.pool.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        while True:
+            with self.lock:
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    return
+                update = queue.popleft()
+            process_update(update)
+
+    def backlog(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+
+def run():
+    # getUpdates doesn't work while a webhook is registered
+    requests.post(f"{TELEGRAM_API_URL}/deleteWebhook")
+    offset = None
+    with ThreadPoolExecutor(max_workers=POLL_WORKERS) as pool:
+        chats = ChatQueues(pool)
+        while True:
+            if chats.backlog() >= POLL_MAX_BACKLOG:
+                time.sleep(0.5)
+                continue
+            try:
+                updates = get_updates(offset)
+            except Exception as e:
+                print(f"getUpdates error: {e}")
+                time.sleep(5)
+                continue
+            if not updates:
+                continue
+
+            # Chats run in parallel, updates within a chat run sequentially
+            for chat_id, chat_updates in group_by_chat(updates).items():
+                chats.dispatch(chat_id, chat_updates)
+            offset = updates[-1]["update_id"] + 1
+            print(f"Dispatched {len(updates)} updates, next offset {offset}")
+
+
+if __name__ == "__main__":
+    run()
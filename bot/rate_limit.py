@@ -0,0 +1,123 @@
+# rate_limit.py
+import json
+import os
+import time
+import uuid
+from redis_client import get_redis
+
+# command -> (bucket capacity, tokens refilled per minute)
+RATE_LIMITS = {
+    "/askmyra": (5, 2),
+    "/trainmyra": (3, 1),
+}
+RATE_LIMITS.update({cmd: tuple(v) for cmd, v in json.loads(os.getenv("RATE_LIMITS") or "{}").items()})
+
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "4"))
+LLM_SLOT_LEASE = int(os.getenv("LLM_SLOT_LEASE", "60"))  # seconds before a crashed holder's slot is reclaimed
+LLM_SLOT_WAIT = float(os.getenv("LLM_SLOT_WAIT", "2"))
+
+BUCKETS_KEY = "rate_limit_buckets"
+INFLIGHT_KEY = "llm_inflight"
+
+# Buckets live in one hash per tenant, field "<cmd>:<user_id>" -> "<tokens>|<last refill ts>"
+_TAKE_TOKEN = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+local capacity = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local tokens = capacity
+local ts = now
+if raw then
+  local sep = string.find(raw, '|', 1, true)
+  tokens = tonumber(string.sub(raw, 1, sep - 1))
+  ts = tonumber(string.sub(raw, sep + 1))
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], ARGV[1], tostring(tokens) .. '|' .. ARGV[4])
+return {allowed, tostring(tokens)}
+"""
+
+_ACQUIRE_SLOT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+  redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+  return 1
+end
+return 0
+"""
+
+
+def take_token(tenant, cmd, user_id):
+    """
+    Spend one token from the user's bucket for cmd.
+    Returns (allowed, retry_after_seconds).
+    """
+    if cmd not in RATE_LIMITS:
+        return True, 0
+    capacity, per_minute = RATE_LIMITS[cmd]
+    rate = per_minute / 60.0
+    r = get_redis()
+    allowed, tokens = r.eval(
+        _TAKE_TOKEN,
+        keys=[tenant.key(BUCKETS_KEY)],
+        args=[f"{cmd}:{user_id}", str(capacity), str(rate), str(time.time())],
+    )
+    if int(allowed) == 1:
+        return True, 0
+    return False, (1 - float(tokens)) / rate if rate > 0 else float("inf")
+
+
+def acquire_llm_slot(wait=LLM_SLOT_WAIT):
+    """
+    Reserve one of LLM_MAX_INFLIGHT global completion slots, waiting up to
+    wait seconds. Returns a slot id to release, or None if busy.
+    """
+    r = get_redis()
+    slot = str(uuid.uuid4())
+    deadline = time.time() + wait
+    while True:
+        acquired = r.eval(
+            _ACQUIRE_SLOT,
+            keys=[INFLIGHT_KEY],
+            args=[str(time.time()), str(LLM_SLOT_LEASE), str(LLM_MAX_INFLIGHT), slot],
+        )
+        if int(acquired) == 1:
+            return slot
+        if time.time() >= deadline:
+            return None
+        time.sleep(0.25)
+
+
+def release_llm_slot(slot):
+    if slot:
+        get_redis().zrem(INFLIGHT_KEY, slot)
+
+
+def rate_limit_state(tenant):
+    """Current (refilled) bucket levels for a tenant, for the metrics endpoint"""
+    r = get_redis()
+    now = time.time()
+    state = {}
+    for field, raw in (r.hgetall(tenant.key(BUCKETS_KEY)) or {}).items():
+        cmd, user_id = field.split(":", 1)
+        if cmd not in RATE_LIMITS:
+            continue
+        capacity, per_minute = RATE_LIMITS[cmd]
+        tokens, ts = (float(x) for x in raw.split("|", 1))
+        tokens = min(capacity, tokens + max(0.0, now - ts) * per_minute / 60.0)
+        name = tenant.user_name(user_id) or user_id
+        state.setdefault(cmd, {})[name] = {"tokens": round(tokens, 2), "capacity": capacity}
+    return state
+
+
+def llm_inflight():
+    r = get_redis()
+    return {
+        "in_flight": r.zcount(INFLIGHT_KEY, time.time() - LLM_SLOT_LEASE, "+inf"),
+        "max_in_flight": LLM_MAX_INFLIGHT,
+    }
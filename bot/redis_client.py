@@ -1,11 +1,27 @@
 import json
 from upstash_redis import Redis
+from upstash_redis.asyncio import Redis as AsyncRedis
 import os
 
 def get_redis():
     return Redis(url=os.getenv("REDIS_URL"), token=os.getenv("REDIS_TOKEN"))
 
-def load_duty_schedule():
+def load_duty_schedule(tenant=None):
     r = get_redis()
-    json_data = r.get("duty_schedule")
+    json_data = r.get(tenant.key("duty_schedule") if tenant else "duty_schedule")
+    return json.loads(json_data or "{}")
+
+
+_async_redis = None
+
+def get_async_redis():
+    # One client per process; only used from the async handlers' event loop
+    global _async_redis
+    if _async_redis is None:
+        _async_redis = AsyncRedis(url=os.getenv("REDIS_URL"), token=os.getenv("REDIS_TOKEN"))
+    return _async_redis
+
+async def load_duty_schedule_async(tenant=None):
+    r = get_async_redis()
+    json_data = await r.get(tenant.key("duty_schedule") if tenant else "duty_schedule")
     return json.loads(json_data or "{}")
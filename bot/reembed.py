@@ -0,0 +1,123 @@
+# reembed.py
+# Resumable bulk re-embedding of Myra's training chunks for a model migration.
+#
+#   1. python reembed.py --model text-embedding-3-large
+#      Streams every chunk without a vector for the new model, embeds it in
+#      batches and stores it as pending_embedding. Safe to stop and re-run;
+#      progress is checkpointed in Redis.
+#   2. Set EMBEDDING_READ_MODELS=text-embedding-3-large,text-embedding-3-small
+#      to dual-read: migrated chunks are scored with the new model, the rest
+#      with the old one.
+#   3. python reembed.py --model text-embedding-3-large --finalize
+#      Promotes pending vectors to the main embedding field. Then set
+#      EMBEDDING_MODEL and EMBEDDING_READ_MODELS to the new model.
+import argparse
+import json
+import os
+from openai import OpenAI
+from pymongo import MongoClient, UpdateOne
+from dotenv import load_dotenv
+from redis_client import get_redis
+from embeddings import embed_texts, missing_model_filter, EMBEDDING_BATCH_SIZE
+from retrieval import bump_generation
+from tenants import all_tenants
+
+load_dotenv()
+
+
+def checkpoint_key(model):
+    return f"reembed_checkpoint:{model}"
+
+
+def load_checkpoint(model):
+    raw = get_redis().get(checkpoint_key(model))
+    return json.loads(raw) if raw else {"last_id": None, "done": 0}
+
+
+def save_checkpoint(model, checkpoint):
+    get_redis().set(checkpoint_key(model), json.dumps(checkpoint))
+
+
+def reembed(collection, client, model, batch_size=EMBEDDING_BATCH_SIZE):
+    checkpoint = load_checkpoint(model)
+    remaining = collection.count_documents(missing_model_filter(model))
+    print(f"{remaining} chunks need {model} vectors, {checkpoint['done']} done so far")
+
+    while remaining:
+        query = missing_model_filter(model)
+        if checkpoint["last_id"] is not None:
+            query = {"$and": [query, {"_id": {"$gt": checkpoint["last_id"]}}]}
+
+        cursor = collection.find(query, {"chunk": 1}).sort("_id", 1).batch_size(batch_size)
+        batch = []
+        processed = 0
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                processed += _embed_batch(collection, client, model, batch, checkpoint)
+                batch = []
+        if batch:
+            processed += _embed_batch(collection, client, model, batch, checkpoint)
+
+        # Chunks trained mid-run can land behind the checkpoint, so sweep again from the start
+        checkpoint["last_id"] = None
+        save_checkpoint(model, checkpoint)
+        remaining = collection.count_documents(missing_model_filter(model))
+        if processed == 0:
+            break
+
+    print(f"Done: {checkpoint['done']} chunks have {model} vectors, {remaining} left")
+
+
+def _embed_batch(collection, client, model, batch, checkpoint):
+    vectors = embed_texts(client, [doc["chunk"] for doc in batch], model)
+    collection.bulk_write([
+        UpdateOne({"_id": doc["_id"]}, {"$set": {"pending_embedding": vector, "pending_embedding_model": model}})
+        for doc, vector in zip(batch, vectors)
+    ], ordered=False)
+    checkpoint["last_id"] = batch[-1]["_id"]
+    checkpoint["done"] += len(batch)
+    save_checkpoint(model, checkpoint)
+    print(f"Re-embedded {checkpoint['done']} chunks (last _id {checkpoint['last_id']})")
+    return len(batch)
+
+
+def finalize(collection, model):
+    result = collection.update_many({"pending_embedding_model": model}, [
+        {"$set": {"embedding": "$pending_embedding", "embedding_model": model}},
+        {"$unset": ["pending_embedding", "pending_embedding_model"]},
+    ])
+    get_redis().delete(checkpoint_key(model))
+    left = collection.count_documents(missing_model_filter(model))
+    print(f"Promoted {result.modified_count} chunks to {model}; {left} chunks still lack {model} vectors")
+
+
+def reload_indexes():
+    # Make running bots pick up the new vectors
+    for tenant in all_tenants():
+        bump_generation(tenant)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-embed Myra's training chunks with a new embedding model")
+    parser.add_argument("--model", required=True, help="target embedding model")
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--finalize", action="store_true", help="promote pending vectors once re-embedding is done")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint")
+    args = parser.parse_args()
+
+    collection = MongoClient(os.getenv("MONGO_URI"))["myra_training"]["embeddings"]
+    if args.finalize:
+        finalize(collection, args.model)
+        reload_indexes()
+        return
+
+    if args.restart:
+        get_redis().delete(checkpoint_key(args.model))
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    reembed(collection, client, args.model, args.batch_size)
+    reload_indexes()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# retrieval.py
+import os
+import re
+import threading
+import numpy as np
+from redis_client import get_redis
+from embeddings import EMBEDDING_READ_MODELS, pick_vector, has_model_filter
+
+GENERATION_KEY = "rag_generation"
+_PROJECTION = {
+    "chunk": 1, "file_name": 1, "tags": 1,
+    "embedding": 1, "embedding_model": 1,
+    "pending_embedding": 1, "pending_embedding_model": 1,
+}
+
+_lock = threading.Lock()
+_tenant_locks = {}  # tenant_id -> Lock held while that tenant's index loads
+_indexes = {}  # tenant_id -> RetrievalIndex
+_indexes_ensured = False
+
+
+def slugify(text):
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+
+
+def doc_tags(doc):
+    """Explicit /trainmyra tags plus the source file name, e.g. duty-sop.pdf -> duty-sop"""
+    tags = {slugify(t) for t in doc.get("tags", [])}
+    file_name = doc.get("file_name")
+    if file_name and file_name != "Text":
+        tags.add(slugify(file_name.rsplit(".", 1)[0]))
+    tags.discard("")
+    return tags
+
+
+def parse_scopes(words):
+    """Split `in:<scope>` words out of a question. Returns (scopes, remaining words)"""
+    scopes = [slugify(w[3:]) for w in words if w.lower().startswith("in:") and len(w) > 3]
+    rest = [w for w in words if not (w.lower().startswith("in:") and len(w) > 3)]
+    return [s for s in scopes if s], rest
+
+
+def parse_tags(words):
+    """Split `tag:<name>` words out of /trainmyra arguments. Returns (tags, remaining words)"""
+    tags = [slugify(w[4:]) for w in words if w.lower().startswith("tag:") and len(w) > 4]
+    rest = [w for w in words if not (w.lower().startswith("tag:") and len(w) > 4)]
+    return [t for t in tags if t], rest
+
+
+class RetrievalIndex:
+    """
+    Snapshot of one tenant's chunks: a normalized matrix per embedding model
+    (with the document position of each row) plus a boolean bitmap per tag
+    over document positions. Arrays may be in-process or memory-mapped.
+    """
+
+    def __init__(self, generation, chunks, rows, matrices, tag_bitmaps):
+        self.generation = generation
+        self.chunks = chunks
+        self.rows = rows
+        self.matrices = matrices
+        self.tag_bitmaps = tag_bitmaps
+
+    def scope_mask(self, scopes):
+        """Bitmap of documents in any of scopes, or None for no scoping"""
+        if not scopes:
+            return None
+        mask = np.zeros(len(self.chunks), dtype=bool)
+        for scope in scopes:
+            if scope in self.tag_bitmaps:
+                mask |= self.tag_bitmaps[scope]
+        return mask
+
+    def search(self, query_embeddings, k, scopes=None):
+        """Top-k (score, chunk, embedding, model) among documents in scope"""
+        mask = self.scope_mask(scopes)
+        scored = []
+        for model, matrix in self.matrices.items():
+            if model not in query_embeddings:
+                continue
+            rows = self.rows[model]
+            if mask is not None:
+                keep = mask[rows]
+                rows, matrix = rows[keep], matrix[keep]
+            if len(rows) == 0:
+                continue
+            query = np.asarray(query_embeddings[model], dtype=np.float32)
+            query = query / (np.linalg.norm(query) or 1.0)
+            sims = matrix @ query
+            top = np.argsort(-sims)[:k]
+            scored += [(float(sims[i]), self.chunks[rows[i]], matrix[i], model) for i in top]
+
+        scored.sort(reverse=True, key=lambda x: x[0])
+        return scored[:k]
+
+
+def build_index(docs, generation):
+    chunks = []
+    rows = {}
+    vectors = {}
+    tags_per_doc = []
+    for doc in docs:
+        model, vector = pick_vector(doc)
+        if model is None:
+            continue
+        rows.setdefault(model, []).append(len(chunks))
+        vectors.setdefault(model, []).append(vector)
+        chunks.append(doc["chunk"])
+        tags_per_doc.append(doc_tags(doc))
+
+    tag_bitmaps = {}
+    for pos, tags in enumerate(tags_per_doc):
+        for tag in tags:
+            if tag not in tag_bitmaps:
+                tag_bitmaps[tag] = np.zeros(len(chunks), dtype=bool)
+            tag_bitmaps[tag][pos] = True
+
+    matrices = {}
+    for model, vecs in vectors.items():
+        matrix = np.asarray(vecs, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrices[model] = matrix / norms
+
+    rows = {model: np.array(r, dtype=np.int64) for model, r in rows.items()}
+    return RetrievalIndex(generation, chunks, rows, matrices, tag_bitmaps)
+
+
+def current_generation(tenant):
+    return int(get_redis().get(tenant.key(GENERATION_KEY)) or 0)
+
+
+def bump_generation(tenant):
+    """Call after adding training chunks so every process reloads its index"""
+    get_redis().incr(tenant.key(GENERATION_KEY))
+
+
+def ensure_indexes(collection):
+    global _indexes_ensured
+    if not _indexes_ensured:
+        collection.create_index([("tenant", 1), ("tags", 1)])
+        _indexes_ensured = True
+
+
+def load_index(collection, tenant, generation, scopes=None):
+    """Index of tenant's chunks; with scopes, only the in-scope ones (via the (tenant, tags) index)"""
+    ensure_indexes(collection)
+    filters = [tenant.mongo_filter(), has_model_filter(EMBEDDING_READ_MODELS)]
+    if scopes:
+        # Chunks trained before tags were stored have none; their file-name
+        # tag is derived in build_index and the scope bitmap filters them
+        filters.append({"$or": [{"tags": {"$in": list(scopes)}}, {"tags": None}]})
+    return build_index(collection.find({"$and": filters}, _PROJECTION), generation)
+
+
+def _tenant_lock(tenant):
+    with _lock:
+        return _tenant_locks.setdefault(tenant.tenant_id, threading.Lock())
+
+
+def get_index(collection, tenant, scopes=None):
+    """
+    This process's index for tenant, reloaded when training has bumped the
+    generation. A scoped query that finds no current index loads just its
+    scopes' chunks from Mongo instead; that partial index isn't kept.
+    """
+    if os.getenv("RAG_SHARED_DIR"):
+        from shared_index import get_shared_index
+        return get_shared_index(collection, tenant)
+
+    generation = current_generation(tenant)
+    index = _indexes.get(tenant.tenant_id)
+    if index is not None and index.generation == generation:
+        return index
+    if scopes:
+        index = load_index(collection, tenant, generation, scopes)
+        print(f"Loaded scoped retrieval index for {tenant} {scopes}: {len(index.chunks)} chunks")
+        return index
+
+    # One lock per tenant, so a reload doesn't stall other tenants' questions
+    with _tenant_lock(tenant):
+        index = _indexes.get(tenant.tenant_id)
+        if index is None or index.generation != generation:
+            index = load_index(collection, tenant, generation)
+            _indexes[tenant.tenant_id] = index
+            print(f"Loaded retrieval index for {tenant}: {len(index.chunks)} chunks, generation {generation}")
+    return index
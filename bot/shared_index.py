@@ -0,0 +1,178 @@
+# shared_index.py
+# Shares one copy of each tenant's retrieval index between worker processes.
+#
+# Set RAG_SHARED_DIR (ideally on tmpfs, e.g. /dev/shm/myra) to enable. The
+# first worker to see a new generation takes a file lock, loads the chunks
+# from Mongo and publishes them as .npy files; every worker then maps those
+# files read-only, so the OS page cache holds a single copy of the vectors.
+# Generations are written to their own directory and switched by atomically
+# replacing a pointer file, so readers never see a half-written index.
+#
+# A dedicated loader can keep indexes warm instead:  python shared_index.py
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+from retrieval import RetrievalIndex, current_generation, load_index
+
+RAG_SHARED_DIR = os.getenv("RAG_SHARED_DIR")
+POINTER_FILE = "current.json"
+
+_lock = threading.Lock()
+_attached = {}  # tenant_id -> (generation dir, RetrievalIndex)
+
+
+class MappedChunks:
+    """Read-only list of chunk texts backed by a memory-mapped UTF-8 blob"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+
+def tenant_dir(tenant):
+    return os.path.join(RAG_SHARED_DIR, tenant.tenant_id)
+
+
+def read_pointer(tenant):
+    try:
+        with open(os.path.join(tenant_dir(tenant), POINTER_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _save(path, array):
+    np.save(path, np.ascontiguousarray(array))
+
+
+def publish(index, tenant):
+    """Write index as a new generation directory and atomically point readers at it"""
+    base = tenant_dir(tenant)
+    gen_name = f"gen-{index.generation}-{uuid.uuid4().hex[:8]}"
+    gen_dir = os.path.join(base, gen_name)
+    os.makedirs(gen_dir)
+
+    encoded = [chunk.encode("utf-8") for chunk in index.chunks]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    _save(os.path.join(gen_dir, "chunks.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    _save(os.path.join(gen_dir, "offsets.npy"), offsets)
+
+    models = sorted(index.matrices)
+    for i, model in enumerate(models):
+        _save(os.path.join(gen_dir, f"matrix-{i}.npy"), index.matrices[model])
+        _save(os.path.join(gen_dir, f"rows-{i}.npy"), index.rows[model])
+    tags = sorted(index.tag_bitmaps)
+    bitmaps = np.array([index.tag_bitmaps[t] for t in tags], dtype=bool).reshape(len(tags), len(index.chunks))
+    _save(os.path.join(gen_dir, "tags.npy"), bitmaps)
+
+    meta = {"generation": index.generation, "models": models, "tags": tags}
+    with open(os.path.join(gen_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    pointer = {"generation": index.generation, "dir": gen_name}
+    tmp = os.path.join(base, f".{POINTER_FILE}.{uuid.uuid4().hex[:8]}")
+    with open(tmp, "w") as f:
+        json.dump(pointer, f)
+        f.flush()
+        os.fsync(f.fileno())
+    previous = read_pointer(tenant)
+    os.replace(tmp, os.path.join(base, POINTER_FILE))
+    _cleanup(base, keep={gen_name, previous["dir"] if previous else None})
+    print(f"Published shared index for {tenant}: generation {index.generation}, {len(index.chunks)} chunks")
+
+
+def _cleanup(base, keep):
+    # Keep the previous generation for workers about to attach to it; workers
+    # already mapping older ones keep their pages until they re-attach
+    for name in os.listdir(base):
+        if name.startswith("gen-") and name not in keep:
+            shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+
+
+def attach(tenant, pointer):
+    gen_dir = os.path.join(tenant_dir(tenant), pointer["dir"])
+    with open(os.path.join(gen_dir, "meta.json")) as f:
+        meta = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(gen_dir, name), mmap_mode="r")
+
+    chunks = MappedChunks(load("chunks.npy"), load("offsets.npy"))
+    matrices = {model: load(f"matrix-{i}.npy") for i, model in enumerate(meta["models"])}
+    rows = {model: load(f"rows-{i}.npy") for i, model in enumerate(meta["models"])}
+    bitmaps = load("tags.npy")
+    tag_bitmaps = {tag: bitmaps[i] for i, tag in enumerate(meta["tags"])}
+    return RetrievalIndex(meta["generation"], chunks, rows, matrices, tag_bitmaps)
+
+
+def ensure_published(collection, tenant):
+    """Publish the tenant's current generation unless it already is; only one process loads at a time"""
+    os.makedirs(tenant_dir(tenant), exist_ok=True)
+    with open(os.path.join(tenant_dir(tenant), ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Read under the lock: a generation read before waiting may already be
+            # stale, and publishing it would roll back the one published meanwhile.
+            # Any mismatch republishes, so a counter that went backwards is followed too
+            generation = current_generation(tenant)
+            pointer = read_pointer(tenant)
+            if pointer is None or pointer["generation"] != generation:
+                publish(load_index(collection, tenant, generation), tenant)
+                pointer = read_pointer(tenant)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return pointer
+
+
+def get_shared_index(collection, tenant):
+    """Read-only mapped index for tenant, publishing a new generation first if needed"""
+    generation = current_generation(tenant)
+    pointer = read_pointer(tenant)
+    if pointer is None or pointer["generation"] != generation:
+        pointer = ensure_published(collection, tenant)
+
+    with _lock:
+        attached = _attached.get(tenant.tenant_id)
+        if attached is None or attached[0] != pointer["dir"]:
+            for attempt in range(3):
+                try:
+                    attached = (pointer["dir"], attach(tenant, pointer))
+                    break
+                except FileNotFoundError:
+                    # A newer generation replaced this one while we were attaching
+                    if attempt == 2:
+                        raise
+                    pointer = read_pointer(tenant)
+            _attached[tenant.tenant_id] = attached
+            print(f"Attached shared index for {tenant}: generation {pointer['generation']}")
+    return attached[1]
+
+
+def main():
+    # Dedicated loader: keep every tenant's shared index at the latest generation
+    from handlers import collection
+    from tenants import all_tenants
+    interval = int(os.getenv("RAG_SHARED_POLL", "5"))
+    while True:
+        for tenant in all_tenants():
+            try:
+                ensure_published(collection, tenant)
+            except Exception as e:
+                print(f"Failed to publish shared index for {tenant}: {e}")
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    main()
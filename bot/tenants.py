@@ -0,0 +1,104 @@
+# tenants.py
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+load_dotenv()
+
+TENANT_FANOUT_WORKERS = int(os.getenv("TENANT_FANOUT_WORKERS", "8"))
+
+
+class Tenant:
+    """
+    One residential college / RA group served by this deployment.
+
+    Redis keys and Mongo documents are namespaced by tenant_id (the group chat
+    ID). The legacy tenant built from GROUP_CHAT_ID/FRIEND_TELEGRAM_MAPPINGS
+    keeps the original un-prefixed keys so existing data stays readable.
+    """
+
+    def __init__(self, tenant_id, group_chat_id, friends, legacy=False):
+        self.tenant_id = str(tenant_id)
+        self.group_chat_id = str(group_chat_id)
+        self.friends = {name: str(uid) for name, uid in friends.items()}
+        self.legacy = legacy
+
+    def key(self, name):
+        """Redis key for this tenant"""
+        return name if self.legacy else f"tenant:{self.tenant_id}:{name}"
+
+    def mongo_filter(self):
+        """Mongo query matching this tenant's training documents"""
+        if self.legacy:
+            # Documents trained before tenancy have no tenant field
+            return {"tenant": {"$in": [self.tenant_id, None]}}
+        return {"tenant": self.tenant_id}
+
+    def user_name(self, user_id):
+        for name, tid in self.friends.items():
+            if tid == str(user_id):
+                return name
+        return None
+
+    def __repr__(self):
+        return f"Tenant({self.tenant_id})"
+
+
+def _load_tenants():
+    tenants = {}
+
+    group_chat_id = os.getenv("GROUP_CHAT_ID")
+    mappings = os.getenv("FRIEND_TELEGRAM_MAPPINGS")
+    if group_chat_id and mappings:
+        tenants[str(group_chat_id)] = Tenant(group_chat_id, group_chat_id, json.loads(mappings), legacy=True)
+
+    # TENANTS = {"<group chat id>": {"friends": {"Name": "<telegram id>"}}}
+    for group_id, config in json.loads(os.getenv("TENANTS") or "{}").items():
+        tenants[str(group_id)] = Tenant(group_id, group_id, config.get("friends", {}))
+
+    return tenants
+
+
+TENANTS = _load_tenants()
+
+
+def all_tenants():
+    return list(TENANTS.values())
+
+
+def tenant_for_chat(chat_id):
+    return TENANTS.get(str(chat_id))
+
+
+def tenants_for_user(user_id):
+    """Every tenant whose allowlist contains user_id"""
+    return [tenant for tenant in TENANTS.values() if tenant.user_name(user_id)]
+
+
+def tenant_for_user(user_id):
+    """First tenant whose allowlist contains user_id (used for DMs)"""
+    tenants = tenants_for_user(user_id)
+    return tenants[0] if tenants else None
+
+
+def resolve_tenant(chat_id, user_id):
+    """Tenant for an incoming message: the group it came from, else the sender's tenant"""
+    tenant = tenant_for_chat(chat_id)
+    if tenant:
+        return tenant if tenant.user_name(user_id) else None
+    return tenant_for_user(user_id)
+
+
+def for_each_tenant(fn):
+    """Run fn(tenant) for every tenant in parallel; one tenant failing doesn't stop the rest"""
+    def run(tenant):
+        try:
+            fn(tenant)
+        except Exception as e:
+            print(f"{fn.__name__} failed for {tenant}: {e}")
+
+    tenants = all_tenants()
+    if not tenants:
+        return
+    with ThreadPoolExecutor(max_workers=min(TENANT_FANOUT_WORKERS, len(tenants))) as pool:
+        list(pool.map(run, tenants))